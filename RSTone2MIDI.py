@@ -1,13 +1,24 @@
 import time
-import psutil
-import pymem
-import rtmidi
-import tkinter as tk
-from tkinter import ttk, scrolledtext, Toplevel, Label, Menu, Scale
 import os
+import re
+import sys
+import json
+import hashlib
+import struct
+import socket
+import argparse
+import asyncio
 import threading
 import queue
-import webbrowser
+import collections
+import weakref
+import bisect
+import zlib
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import urlsplit
+
+# psutil, rtmidi and pymem are imported where they are first used, and tkinter only by
+# load_tkinter(), so the headless mode starts fast and never loads Tk.
 
 """
 RSTone2MIDI
@@ -19,32 +30,24 @@ Github: https://github.com/bboylalu/RSTone2MIDI
 The code was written with the help of Google Gemini, so if you want to throw rocks, please rock on \m/!!!
 """
 
-def get_process_id_by_window_title(window_title):
-    """Gets the process ID of a process by its name."""
-    try:
-        for proc in psutil.process_iter():
-            try:
-                if proc.name() == "Rocksmith2014.exe":
-                    return proc.pid
-            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-                pass
-        return None
-    except Exception as e:
-        print(f"Error iterating processes: {e}")
-        return None
-
-def get_module_base_address(process_handle, module_name):
-    """Gets the base address of a module in a process."""
+def get_module(process_handle, module_name):
+    """Gets a loaded module (base address, image size, file name) of a process."""
     try:
         modules = process_handle.list_modules()
         for module in modules:
             if module.name == module_name:
-                return module.lpBaseOfDll
+                return module
         return None
     except Exception as e:
+        metrics.count_error("get_module")
         print(f"Error getting base address: {e}")
         return None
 
+def get_module_base_address(process_handle, module_name):
+    """Gets the base address of a module in a process."""
+    module = get_module(process_handle, module_name)
+    return None if module is None else module.lpBaseOfDll
+
 def read_memory_with_offsets(process_handle, base_address, base_pointer_offset, offsets):
     """Reads a value from memory, handling null pointers."""
     try:
@@ -69,10 +72,170 @@ def read_memory_with_offsets(process_handle, base_address, base_pointer_offset,
         print(f"An error occurred in read_memory_with_offsets: {e}")
         return None
 
+class PymemReader:
+    """Memory reader backed by a pymem handle (one ReadProcessMemory call per read)."""
+
+    def __init__(self, process_handle):
+        self.process_handle = process_handle
+        self.reads = 0  # Syscalls made so far
+
+    def read_int(self, address):
+        self.reads += 1
+        return self.process_handle.read_int(address)
+
+    def read_bytes(self, address, size):
+        self.reads += 1
+        return self.process_handle.read_bytes(address, size)
+
+class ProcMemReader:
+    """Memory reader backed by /proc/<pid>/mem, so the pointer code can be tested on Linux."""
+
+    def __init__(self, pid):
+        self.fd = os.open(f"/proc/{pid}/mem", os.O_RDONLY)
+        self.reads = 0
+
+    def read_bytes(self, address, size):
+        self.reads += 1
+        data = os.pread(self.fd, size, address)
+        if len(data) != size:
+            raise OSError(f"Short read at {address:#x}")
+        return data
+
+    def read_int(self, address):
+        return struct.unpack("<i", self.read_bytes(address, 4))[0]
+
+    def close(self):
+        os.close(self.fd)
+
+class FakeMemoryReader:
+    """Memory reader over mapped bytearrays, standing in for a game process in tests and benchmarks."""
+
+    def __init__(self):
+        self.regions = []  # (start address, bytearray)
+        self.reads = 0
+
+    def map(self, address, size):
+        """Makes [address, address + size) readable, zero filled."""
+        self.regions.append((address, bytearray(size)))
+
+    def _locate(self, address, size):
+        for start, data in self.regions:
+            if start <= address and address + size <= start + len(data):
+                return data, address - start
+        raise ValueError(f"Could not read memory at {address:#x}")
+
+    def read_bytes(self, address, size):
+        self.reads += 1
+        data, offset = self._locate(address, size)
+        return bytes(data[offset:offset + size])
+
+    def read_int(self, address):
+        self.reads += 1
+        data, offset = self._locate(address, 4)
+        return struct.unpack_from("<i", data, offset)[0]
+
+    def write_int(self, address, value):
+        data, offset = self._locate(address, 4)
+        struct.pack_into("<i", data, offset, value)
+
+    def write_bytes(self, address, value):
+        data, offset = self._locate(address, len(value))
+        data[offset:offset + len(value)] = value
+
+SCAN_CACHE_FILE = "RSTone2MIDI_scan_cache.json"
+SCAN_CHUNK_SIZE = 4 * 1024 * 1024  # Bytes read from the game per ReadProcessMemory call while scanning
+
+def compile_signature(pattern):
+    """Turns an AOB pattern like "A1 ?? ?? ?? ?? 8B 48 10" into a compiled bytes regex."""
+    parts = []
+    for token in pattern.split():
+        if token in ("?", "??"):
+            parts.append(b".")
+        else:
+            parts.append(re.escape(bytes([int(token, 16)])))
+    if not parts:
+        raise ValueError("Empty signature")
+    return re.compile(b"".join(parts), re.DOTALL), len(parts)
+
+def scan_memory(reader, start, size, pattern, chunk_size=SCAN_CHUNK_SIZE):
+    """Returns the address of the first match of an AOB pattern in [start, start + size), or None.
+
+    Memory is read in large chunks that overlap by the pattern length, so matches across chunk borders are found.
+    """
+    regex, length = compile_signature(pattern)
+    end = start + size
+    address = start
+    while address < end:
+        read_size = min(chunk_size + length - 1, end - address)
+        try:
+            data = reader.read_bytes(address, read_size)
+        except Exception:
+            data = None  # Unreadable section, skip it
+        if data is not None:
+            match = regex.search(data)
+            if match is not None:
+                return address + match.start()
+        address += chunk_size
+    return None
+
+def find_base_pointer_offset(reader, module_base, module_size, signature):
+    """Scans the module image for a signature and returns the base pointer offset it references, or None.
+
+    signature: {"pattern": "A1 ?? ?? ?? ?? 8B 48 10", "offset": 1, "relative": false}
+    "offset" is where the 4-byte address sits inside the match. Absolute addresses (32-bit games)
+    are used as-is, relative ones (x64 RIP addressing) are counted from the end of those 4 bytes.
+    """
+    match_address = scan_memory(reader, module_base, module_size, signature["pattern"])
+    if match_address is None:
+        return None
+    operand_address = match_address + signature.get("offset", 0)
+    operand = reader.read_bytes(operand_address, 4)
+    if signature.get("relative", False):
+        target = operand_address + 4 + struct.unpack("<i", operand)[0]
+    else:
+        target = struct.unpack("<I", operand)[0]
+    return target - module_base
+
+def executable_key(path):
+    """Identifies one build of an executable by size, timestamp and a hash of its PE header."""
+    stat = os.stat(path)
+    with open(path, "rb") as f:
+        header_hash = hashlib.sha1(f.read(4096)).hexdigest()
+    return f"{stat.st_size}:{stat.st_mtime_ns}:{header_hash}"
+
+def resolve_base_pointer_offset(reader, module, signature, cache_file=SCAN_CACHE_FILE):
+    """Finds the base pointer offset for this game build, scanning only if the cache has no answer.
+
+    Returns (offset, how it was found) where the second value is "cache", "scan" or None if not found.
+    """
+    key = None
+    cache = {}
+    try:
+        key = f"{executable_key(module.filename)}:{signature['pattern']}:{signature.get('offset', 0)}"
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if key in cache:
+        return cache[key], "cache"
+
+    offset = find_base_pointer_offset(reader, module.lpBaseOfDll, module.SizeOfImage, signature)
+    if offset is None:
+        return None, None
+    if key is not None:
+        cache[key] = offset
+        try:
+            with open(cache_file, "w") as f:
+                json.dump(cache, f, indent=2)
+        except Exception as e:
+            metrics.count_error("scan_cache")
+            print(f"Error writing to {cache_file}: {e}")
+    return offset, "scan"
+
 def send_midi_control_change(channel, control, value, midi_out):
     """Sends a MIDI Control Change message using rtmidi."""
     try:
-        cc_message = [0xB0 | (channel - 1), control, value]
+        cc_message = bytes((0xB0 | (channel - 1), control, value))
         midi_out.send_message(cc_message)
         #print(f"Sent MIDI CC: Channel {channel}, Control {control}, Value {value}")  # Now handled by the GUI
     except Exception as e:
@@ -81,28 +244,1005 @@ def send_midi_control_change(channel, control, value, midi_out):
 def send_midi_program_change(channel, program, midi_out):
     """Sends a MIDI program change message using rtmidi."""
     try:
-        program_change_message = [0xC0 | (channel - 1), program]
+        program_change_message = bytes((0xC0 | (channel - 1), program))
         midi_out.send_message(program_change_message)
         #print(f"Sent MIDI: Channel {channel}, Program {program}")  # Now handled by the GUI
     except Exception as e:
         print(f"Error sending MIDI: {e}")
 
-def is_game_running(window_title):
-    """Checks if the game is running."""
-    return get_process_id_by_window_title(window_title) is not None
+MIDI_MAX_PENDING = 256  # A port this far behind is treated as wedged and new messages for it are dropped
+
+class SendTiming:
+    """Records the "message sent" latency of one tone change once the last port it went to has called its driver."""
+
+    def __init__(self, stats, poll_start, ports):
+        self.stats = stats
+        self.poll_start = poll_start
+        self.lock = threading.Lock()
+        self.remaining = ports
+        self.sent = False  # At least one port sent it, the others may have dropped it
+
+    def done(self, sent=True):
+        with self.lock:
+            self.remaining -= 1
+            self.sent = self.sent or sent
+            last = self.remaining == 0
+        if last and self.sent:
+            self.stats.record(STAGE_SEND, time.perf_counter() - self.poll_start)
+
+class MidiPort:
+    """One open MIDI output with its own sender thread, so a slow driver only ever stalls itself."""
+
+    def __init__(self, name, midi_out, max_pending=MIDI_MAX_PENDING):
+        self.name = name
+        self.midi_out = midi_out
+        self.max_pending = max_pending
+        self.queue = queue.SimpleQueue()  # (encoded message, enqueue time, SendTiming or None), None stops the thread
+        self.sent = 0
+        self.errors = 0
+        self.dropped = 0
+        self.send_times = RollingHistogram()  # Time spent inside the driver call
+        self.queue_times = RollingHistogram()  # Time from enqueue until the driver returned
+        self.thread = threading.Thread(target=self._run, name=f"MIDI out: {name}")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def send(self, message, timing=None):
+        if self.queue.qsize() >= self.max_pending:
+            self.dropped += 1
+            if timing is not None:
+                timing.done(sent=False)
+            return
+        self.queue.put((message, time.perf_counter(), timing))
+
+    def send_batch(self, messages, timing=None):
+        """Queues the messages of one tone change; outputs with send_messages() get them in one call (one datagram).
+
+        timing, if given, is told when the driver returned from the last of them.
+        """
+        if not hasattr(self.midi_out, "send_messages"):
+            for i, message in enumerate(messages):
+                self.send(message, timing if i == len(messages) - 1 else None)
+            return
+        if self.queue.qsize() >= self.max_pending:
+            self.dropped += len(messages)
+            if timing is not None:
+                timing.done(sent=False)
+            return
+        self.queue.put((list(messages), time.perf_counter(), timing))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            message, queued_at, timing = item
+            send_start = time.perf_counter()
+            try:
+                if isinstance(message, list):
+                    self.midi_out.send_messages(message)
+                    self.sent += len(message)
+                else:
+                    self.midi_out.send_message(message)
+                    self.sent += 1
+            except Exception as e:
+                self.errors += 1
+                metrics.count_error("midi_port")
+                print(f"Error sending MIDI on {self.name}: {e}")
+            send_end = time.perf_counter()
+            self.send_times.add(send_end - send_start)
+            self.queue_times.add(send_end - queued_at)
+            if timing is not None:
+                timing.done()
+
+    def close(self, timeout=1.0):
+        self.queue.put(None)
+        self.thread.join(timeout)
+        try:
+            self.midi_out.close_port()
+        except Exception:
+            pass
+
+    def summary(self):
+        return {
+            "sent": self.sent,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "pending": self.queue.qsize(),
+            "send": self.send_times.summary(),
+            "queued": self.queue_times.summary(),
+        }
+
+OSC_ADDRESS = "/midi"
+
+def osc_string(value):
+    """An OSC string: NUL terminated and padded to a multiple of 4 bytes."""
+    data = value.encode() + b"\0"
+    return data + b"\0" * (-len(data) % 4)
+
+def osc_message(address, message):
+    """One MIDI message as OSC: a MIDI argument ("m") when it fits in 3 bytes, otherwise a blob (sysex)."""
+    if len(message) <= 3 and message[0] != 0xF0:
+        return osc_string(address) + osc_string(",m") + b"\0" + message + b"\0" * (3 - len(message))  # Port id 0, status, data
+    return osc_string(address) + osc_string(",b") + struct.pack(">i", len(message)) + message + b"\0" * (-len(message) % 4)
+
+def osc_bundle(elements):
+    """An OSC bundle to be applied at once ("immediately" time tag)."""
+    return b"#bundle\0" + struct.pack(">Q", 1) + b"".join(struct.pack(">i", len(element)) + element for element in elements)
+
+class UdpMidiOut:
+    """Sends MIDI to another machine over UDP, as raw MIDI bytes or as OSC, one datagram per send.
+
+    Has the send_message() of rtmidi.MidiOut so it can sit behind a MidiPort. The socket is
+    connected once, so the host name is resolved once and every send is a single syscall.
+    """
+
+    def __init__(self, host, port, protocol="udp", osc_address=OSC_ADDRESS):
+        if protocol not in ("udp", "osc"):
+            raise ValueError(f"Unknown network protocol '{protocol}', use udp or osc")
+        family, _, _, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+        self.protocol = protocol
+        self.osc_address = osc_address
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.socket.connect(address)
+        self.datagrams = 0
+
+    @classmethod
+    def from_url(cls, url):
+        parts = urlsplit(url)
+        if parts.hostname is None or parts.port is None:
+            raise ValueError(f"Network target '{url}' needs a host and a port, e.g. osc://192.168.1.20:9000/midi")
+        return cls(parts.hostname, parts.port, parts.scheme, parts.path or OSC_ADDRESS)
+
+    def encode(self, messages):
+        if self.protocol == "udp":
+            return b"".join(messages)
+        if len(messages) == 1:
+            return osc_message(self.osc_address, messages[0])
+        return osc_bundle([osc_message(self.osc_address, message) for message in messages])
+
+    def send_message(self, message):
+        self.send_messages([bytes(message)])
+
+    def send_messages(self, messages):
+        self.socket.send(self.encode(messages))
+        self.datagrams += 1
+
+    def close_port(self):
+        self.socket.close()
+
+class MidiOutputEngine:
+    """Owns every open MIDI port and fans each message out to all of them.
+
+    It has the same send_message() as rtmidi.MidiOut, so the send helpers work with either.
+    The caller only enqueues; the drivers are called from the per-port threads.
+    """
+
+    def __init__(self):
+        self.ports = []
+        self.opened = {}  # rtmidi port index or network URL -> MidiPort, so each is opened once
+
+    def add_port(self, name, midi_out):
+        port = MidiPort(name, midi_out)
+        port.start()
+        self.ports.append(port)
+        return port
+
+    def open_port(self, index):
+        """Opens an rtmidi output by index and adds it (or returns it if it is open already)."""
+        if index in self.opened:
+            return self.opened[index]
+        import rtmidi
+        midi_out = rtmidi.MidiOut()
+        name = midi_out.get_ports()[index]
+        midi_out.open_port(index)
+        self.opened[index] = self.add_port(name, midi_out)
+        return self.opened[index]
+
+    def add_network_target(self, url):
+        """Adds a UDP output, e.g. "udp://192.168.1.20:5004" or "osc://192.168.1.20:9000/midi"."""
+        if url not in self.opened:
+            self.opened[url] = self.add_port(url, UdpMidiOut.from_url(url))
+        return self.opened[url]
+
+    def send_message(self, message):
+        if session_recorder is not None:
+            session_recorder.record_midi(message)
+        for port in self.ports:
+            port.send(message)
+
+    def send_messages(self, messages, stats=None, poll_start=None):
+        """Sends the messages of one tone change together.
+
+        With stats, the "message sent" latency since poll_start is recorded once every port's driver returned.
+        """
+        if session_recorder is not None:
+            for message in messages:
+                session_recorder.record_midi(message)
+        timing = None
+        if stats is not None:
+            if not self.ports:
+                return
+            timing = SendTiming(stats, poll_start, len(self.ports))
+        for port in self.ports:
+            port.send_batch(messages, timing)
+
+    def close(self):
+        for port in self.ports:
+            port.close()
+        self.ports = []
+        self.opened = {}
+
+    def summary(self):
+        return {port.name: port.summary() for port in self.ports}
+
+class MidiRoute(MidiOutputEngine):
+    """Sends to some of a MidiOutputEngine's ports only; the engine owns them and closes them."""
+
+    def __init__(self, ports):
+        self.ports = list(ports)
+        self.opened = {}
+
+    def close(self):
+        pass
+
+PROCESS_ATTACHED = "attached"
+PROCESS_DETACHED = "detached"
+
+class ProcessWatcher:
+    """Finds the game process once, then only checks that the cached PID is still alive.
+
+    With several copies of the game running, instance picks one of them by start order (0 is the oldest).
+    A copy another watcher is attached to is never taken, so when the oldest exits the others keep theirs
+    and its watcher waits for a new copy.
+    """
+
+    watchers = weakref.WeakSet()  # Every live watcher, to skip the processes the others hold
+
+    def __init__(self, process_name, alive_interval=0.25, rescan_min=0.5, rescan_max=5.0, instance=0):
+        self.process_name = process_name
+        self.instance = instance
+        self.alive_interval = alive_interval  # Seconds between liveness checks of the cached PID
+        self.rescan_min = rescan_min  # First re-scan delay after the game exits
+        self.rescan_max = rescan_max  # Slowest re-scan delay while the game is absent
+        self.pid = None
+        self.proc = None
+        self.full_scans = 0  # How many times every process was walked
+        self.alive_checks = 0
+        self.attaches = 0
+        self.detaches = 0
+        self._rescan_interval = rescan_min
+        self._next_scan = 0.0
+        self._next_alive_check = 0.0
+        ProcessWatcher.watchers.add(self)
+
+    @property
+    def attached(self):
+        return self.proc is not None
+
+    def _scan(self):
+        """Walks every process once, looking for the game executable."""
+        import psutil
+        self.full_scans += 1
+        others = [watcher for watcher in list(ProcessWatcher.watchers) if watcher is not self and watcher.process_name == self.process_name]
+        claimed = {watcher.pid for watcher in others if watcher.pid is not None}
+        # The unclaimed copies go in start order to the waiting watchers, lowest instance first
+        index = sum(1 for watcher in others if watcher.pid is None and watcher.instance < self.instance)
+        try:
+            matches = [proc for proc in psutil.process_iter(["name", "create_time"])
+                       if proc.info["name"] == self.process_name and proc.pid not in claimed]
+            matches.sort(key=lambda proc: (proc.info["create_time"] or 0, proc.pid))  # PIDs are reused, so they don't follow start order
+            if index < len(matches):
+                return matches[index]
+        except Exception as e:
+            metrics.count_error("process_scan")
+            print(f"Error iterating processes: {e}")
+        return None
+
+    def _is_alive(self):
+        """Checks only the cached process (also guards against PID reuse)."""
+        import psutil
+        self.alive_checks += 1
+        try:
+            return self.proc.is_running() and self.proc.status() != psutil.STATUS_ZOMBIE
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return False
+
+    def poll(self):
+        """Returns PROCESS_ATTACHED / PROCESS_DETACHED when the game appears or exits, otherwise None."""
+        now = time.monotonic()
+
+        if self.proc is not None:
+            if now < self._next_alive_check:
+                return None
+            self._next_alive_check = now + self.alive_interval
+            if self._is_alive():
+                return None
+            self.proc = None
+            self.pid = None
+            self.detaches += 1
+            self._rescan_interval = self.rescan_min
+            self._next_scan = now + self._rescan_interval
+            return PROCESS_DETACHED
+
+        if now < self._next_scan:
+            return None
+        proc = self._scan()
+        if proc is None:
+            # Back off while the game is absent, so idle time doesn't cost a scan per tick
+            self._next_scan = now + self._rescan_interval
+            self._rescan_interval = min(self._rescan_interval * 2, self.rescan_max)
+            return None
+        self.proc = proc
+        self.pid = proc.pid
+        self.attaches += 1
+        self._next_alive_check = now + self.alive_interval
+        return PROCESS_ATTACHED
+
+POLL_STATE_ACTIVE = "active"  # A song is loaded and the tone pointer resolves
+POLL_STATE_IDLE = "idle"  # The game is running but the tone pointer is null (menus, loading)
+POLL_STATE_ABSENT = "absent"  # The game is not running
+
+POLL_INTERVAL_ACTIVE = 0.004  # Seconds between polls during a song
+POLL_INTERVAL_IDLE_MAX = 0.1  # Idle polling backs off up to this
+POLL_INTERVAL_ABSENT = 0.05  # Keeps the test slider responsive while the game is closed
+TARGET_LATENCY = 0.01  # Worst-case time from a tone change to its detection
+
+class PollScheduler:
+    """Deadline loop that polls fast during a song and backs off otherwise.
+
+    Uses time.perf_counter(), which is monotonic and, unlike time.monotonic() on
+    older Pythons for Windows, has sub-millisecond resolution.
+    """
+
+    def __init__(self, active_interval=POLL_INTERVAL_ACTIVE, idle_interval_max=POLL_INTERVAL_IDLE_MAX,
+                 absent_interval=POLL_INTERVAL_ABSENT, target_latency=TARGET_LATENCY, min_interval=0.001):
+        self.active_interval = active_interval
+        self.idle_interval_max = idle_interval_max
+        self.absent_interval = absent_interval
+        self.target_latency = target_latency  # None disables the latency cap
+        self.min_interval = min_interval
+        self.state = POLL_STATE_ABSENT
+        self.ticks = 0
+        self.overruns = 0  # Ticks that started after their deadline
+        self.overrun_time = 0.0  # Total seconds lost to overruns
+        self.work_time = 0.0  # Decaying peak of the time spent between two waits
+        self._idle_interval = active_interval
+        self._deadline = time.perf_counter()
+        self._wake = self._deadline
+        self._confirm = False
+
+    def set_state(self, state):
+        if state != self.state and state == POLL_STATE_ACTIVE:
+            self._idle_interval = self.active_interval
+        self.state = state
+
+    def interval(self):
+        """The sleep between two polls in the current state."""
+        if self.state == POLL_STATE_ABSENT:
+            return self.absent_interval
+        if self.state == POLL_STATE_IDLE:
+            return self._idle_interval
+        interval = self.active_interval
+        if self.target_latency is not None:
+            # A change right after a read is seen one interval plus one read later
+            interval = min(interval, self.target_latency - self.work_time)
+        return max(interval, self.min_interval)
+
+    def confirm_soon(self):
+        """Makes the next poll come after min_interval, to confirm a value that was just read."""
+        self._confirm = True
+
+    def next_delay(self):
+        """Advances to the next deadline and returns how long to sleep until it, resyncing after an overrun."""
+        now = time.perf_counter()
+        self.work_time = max(now - self._wake, self.work_time * 0.99)
+        if self._confirm:
+            self._confirm = False
+            self._deadline += self.min_interval
+        else:
+            self._deadline += self.interval()
+        if self.state == POLL_STATE_IDLE:
+            self._idle_interval = min(self._idle_interval * 2, self.idle_interval_max)
+        if self._deadline <= now:
+            self.overruns += 1
+            self.overrun_time += now - self._deadline
+            self._deadline = now
+            return 0.0
+        return self._deadline - now
+
+    def woke(self):
+        """Marks the start of a tick, for callers that sleep on their own (e.g. asyncio.sleep)."""
+        self._wake = time.perf_counter()
+        self.ticks += 1
+
+    def wait(self):
+        """Sleeps until the next deadline."""
+        delay = self.next_delay()
+        if delay > 0:
+            time.sleep(delay)
+        self.woke()
+
+# Latency stages, each measured from the start of the poll that saw the change
+STAGE_READ = "memory read"
+STAGE_DETECT = "change detected"
+STAGE_SEND = "message sent"
+STAGE_GUI = "gui notified"
+LATENCY_STAGES = [STAGE_READ, STAGE_DETECT, STAGE_SEND, STAGE_GUI]
+
+STATS_FILE = "RSTone2MIDI_stats.json"
+
+class RollingHistogram:
+    """Keeps the last N samples and reports percentiles over them."""
+
+    def __init__(self, size=1000):
+        self.samples = collections.deque(maxlen=size)
+        self.count = 0  # All samples ever added, not just the ones still in the window
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    def summary(self):
+        """Returns count, p50, p99 and max of the window, in milliseconds."""
+        if not self.samples:
+            return {"count": self.count, "p50_ms": None, "p99_ms": None, "max_ms": None}
+        ordered = sorted(self.samples)
+        last = len(ordered) - 1
+        return {
+            "count": self.count,
+            "p50_ms": round(ordered[last * 50 // 100] * 1000, 3),
+            "p99_ms": round(ordered[last * 99 // 100] * 1000, 3),
+            "max_ms": round(ordered[last] * 1000, 3),
+        }
+
+class LatencyStats:
+    """Rolling latency histograms per pipeline stage, written by the engine thread and read by the GUI."""
+
+    def __init__(self, size=1000, parent=None):
+        self.lock = threading.Lock()
+        self.histograms = {stage: RollingHistogram(size) for stage in LATENCY_STAGES}
+        self.parent = parent  # Also gets every sample, e.g. the overall stats of per-source ones
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.histograms[stage].add(seconds)
+        if self.parent is not None:
+            self.parent.record(stage, seconds)
+
+    def summary(self):
+        with self.lock:
+            return {stage: histogram.summary() for stage, histogram in self.histograms.items()}
+
+    def format(self):
+        """Human readable table for the stats window."""
+        lines = [f"{'Stage':<18}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        for stage, values in self.summary().items():
+            cells = ["-" if values[key] is None else f"{values[key]:.3f}" for key in ("p50_ms", "p99_ms", "max_ms")]
+            lines.append(f"{stage:<18}{values['count']:>8}{cells[0]:>10}{cells[1]:>10}{cells[2]:>10}")
+        return "\n".join(lines)
+
+    def dump(self, path=STATS_FILE):
+        """Writes the current percentiles as JSON, for scripts and regression checks."""
+        try:
+            with open(path, "w") as f:
+                json.dump({"time": time.time(), "stages": self.summary()}, f, indent=2)
+        except Exception as e:
+            metrics.count_error("stats_file")
+            print(f"Error writing to {path}: {e}")
+
+latency_stats = LatencyStats()
+
+METRICS_ADDRESS = "127.0.0.1:9477"
+METRICS_FILE = "RSTone2MIDI_metrics.json"
+METRICS_DUMP_INTERVAL = 10.0  # Seconds between two JSON dumps
+
+class MetricsRegistry:
+    """Runtime metrics, read from the engine objects' own counters when scraped instead of being updated every tick.
+
+    Served in the Prometheus text format on /metrics (JSON on /metrics.json) and dumped to a JSON file periodically.
+    """
+
+    def __init__(self):
+        self.sources = {}  # watcher, scheduler, session, watches, tone_filter, midi_out, gui_queue, sources
+        self.errors = collections.Counter()  # Errors that are otherwise only printed, by where they happened
+        self.errors_lock = threading.Lock()  # Counted from the MIDI port threads too
+        self.rate_lock = threading.Lock()  # collect() runs on the HTTP handler threads too
+        self.poll_rate = 0.0  # Polls per second over the last sampling window
+        self._last_ticks = None  # (perf_counter, ticks) at the start of the current window
+
+    def set_source(self, name, source):
+        """Registers an engine object to read metrics from; None forgets it (e.g. the watches of a closed game)."""
+        if source is None:
+            self.sources.pop(name, None)
+        else:
+            self.sources[name] = source
+
+    def count_error(self, where):
+        with self.errors_lock:
+            self.errors[where] += 1
+
+    def sample_poll_rate(self):
+        """Closes the poll rate window and starts the next one; only the dump thread calls it, so scrapes don't move it."""
+        scheduler = self.sources.get("scheduler")
+        now = time.perf_counter()
+        with self.rate_lock:
+            if scheduler is None:
+                self._last_ticks = None
+                self.poll_rate = 0.0
+                return
+            if self._last_ticks is not None and now > self._last_ticks[0]:
+                self.poll_rate = (scheduler.ticks - self._last_ticks[1]) / (now - self._last_ticks[0])
+            self._last_ticks = (now, scheduler.ticks)
+
+    def collect(self):
+        """Returns [(name, type, help, [(labels, value)])] for everything currently registered."""
+        collected = []
+
+        def add(name, kind, help_text, samples):
+            collected.append((name, kind, help_text, samples if isinstance(samples, list) else [({}, samples)]))
+
+        scheduler = self.sources.get("scheduler")
+        if scheduler is not None:
+            with self.rate_lock:
+                rate = self.poll_rate
+            add("poll_ticks_total", "counter", "Poll loop ticks", scheduler.ticks)
+            add("poll_rate_hz", "gauge", "Polls per second over the last dump interval", round(rate, 1))
+            add("poll_state", "gauge", "1 for the current poll state",
+                [({"state": state}, int(scheduler.state == state)) for state in (POLL_STATE_ACTIVE, POLL_STATE_IDLE, POLL_STATE_ABSENT)])
+            add("poll_overruns_total", "counter", "Ticks that started after their deadline", scheduler.overruns)
+            add("poll_overrun_seconds_total", "counter", "Time lost to overruns", round(scheduler.overrun_time, 6))
+
+        watcher = self.sources.get("watcher")
+        if watcher is not None:
+            add("process_scans_total", "counter", "Full process list scans", watcher.full_scans)
+            add("process_attached", "gauge", "1 while the game process is attached", int(watcher.attached))
+
+        session = self.sources.get("session")
+        if session is not None:
+            add("attaches_total", "counter", "Successful attaches to the game process", session.attaches)
+            add("attach_failures_total", "counter", "Failed attaches and read errors that dropped the process handle", session.failures)
+            if session.attach_time is not None:
+                add("attach_seconds", "gauge", "Time the last attach took", round(session.attach_time, 6))
+
+        watches = self.sources.get("watches")
+        if watches is not None:
+            add("memory_reads_total", "counter", "Memory read syscalls", watches.total_reads)
+            add("memory_read_failures_total", "counter", "Memory reads that failed", watches.read_failures)
+            add("memory_null_chains_total", "counter", "Pointer chain walks that hit a null pointer", watches.null_chains)
+            add("memory_chain_walks_total", "counter", "Full pointer chain walks", watches.resolves)
+
+        tone_filter = self.sources.get("tone_filter")
+        if tone_filter is not None:
+            add("tone_glitches_total", "counter", "Tone reads dropped by the filter", tone_filter.glitches)
+            add("tone_suppressed_total", "counter", "Redundant tone sends suppressed", tone_filter.suppressed)
+
+        midi_out = self.sources.get("midi_out")
+        if midi_out is not None:
+            ports = list(midi_out.ports)
+            add("midi_sent_total", "counter", "MIDI messages sent", [({"port": port.name}, port.sent) for port in ports])
+            add("midi_errors_total", "counter", "MIDI sends that failed", [({"port": port.name}, port.errors) for port in ports])
+            add("midi_dropped_total", "counter", "MIDI messages dropped for a wedged port", [({"port": port.name}, port.dropped) for port in ports])
+            add("midi_queue_depth", "gauge", "MIDI messages waiting to be sent", [({"port": port.name}, port.queue.qsize()) for port in ports])
+
+        gui_queue = self.sources.get("gui_queue")
+        if gui_queue is not None:
+            add("gui_queue_depth", "gauge", "Messages waiting for the GUI or console", gui_queue.qsize())
+
+        if hooks.hooks:
+            add("hook_calls_total", "counter", "Hook calls", [({"hook": hook.name}, hook.calls) for hook in hooks.hooks])
+            add("hook_errors_total", "counter", "Hook calls that raised", [({"hook": hook.name}, hook.errors) for hook in hooks.hooks])
+            add("hook_timeouts_total", "counter", "Hook calls that took longer than their timeout", [({"hook": hook.name}, hook.timeouts) for hook in hooks.hooks])
+            add("hook_dropped_total", "counter", "Events not given to a hook that was behind", [({"hook": hook.name}, hook.dropped) for hook in hooks.hooks])
+        with self.errors_lock:
+            errors = sorted(self.errors.items())
+        add("errors_total", "counter", "Errors that were only printed", [({"where": where}, count) for where, count in errors])
+        quantiles = []
+        for stage, values in latency_stats.summary().items():
+            for quantile, key in (("0.5", "p50_ms"), ("0.99", "p99_ms"), ("1", "max_ms")):
+                if values[key] is not None:
+                    quantiles.append(({"stage": stage, "quantile": quantile}, values[key] / 1000))
+        add("latency_seconds", "gauge", "Tone change latency per pipeline stage", quantiles)
+
+        sources = self.sources.get("sources")
+        if sources:
+            def per_source(read):
+                samples = []
+                for source in sources:
+                    value = read(source)
+                    if value is not None:
+                        samples.append(({"source": source.name}, value))
+                return samples
+
+            # The single source metrics, labelled by source. Process, attach and memory counters belong to the
+            # source's game instance, so the sources on the same game report the same values.
+            add("process_scans_total", "counter", "Full process list scans", per_source(lambda source: source.game.watcher.full_scans))
+            add("process_attached", "gauge", "1 while the game process is attached", per_source(lambda source: int(source.game.watcher.attached)))
+            add("attaches_total", "counter", "Successful attaches to the game process", per_source(lambda source: source.game.session.attaches))
+            add("attach_failures_total", "counter", "Failed attaches and read errors that dropped the process handle",
+                per_source(lambda source: source.game.session.failures))
+            add("attach_seconds", "gauge", "Time the last attach took",
+                per_source(lambda source: None if source.game.session.attach_time is None else round(source.game.session.attach_time, 6)))
+            watches = {source.name: source.game.watches for source in sources}  # Read once, the engine thread may drop them
+            add("memory_reads_total", "counter", "Memory read syscalls",
+                per_source(lambda source: None if watches[source.name] is None else watches[source.name].total_reads))
+            add("memory_read_failures_total", "counter", "Memory reads that failed",
+                per_source(lambda source: None if watches[source.name] is None else watches[source.name].read_failures))
+            add("memory_null_chains_total", "counter", "Pointer chain walks that hit a null pointer",
+                per_source(lambda source: None if watches[source.name] is None else watches[source.name].null_chains))
+            add("memory_chain_walks_total", "counter", "Full pointer chain walks",
+                per_source(lambda source: None if watches[source.name] is None else watches[source.name].resolves))
+            add("tone_glitches_total", "counter", "Tone reads dropped by the filter",
+                per_source(lambda source: None if source.tone_filter is None else source.tone_filter.glitches))
+            add("tone_suppressed_total", "counter", "Redundant tone sends suppressed",
+                per_source(lambda source: None if source.tone_filter is None else source.tone_filter.suppressed))
+            add("source_attached", "gauge", "1 while the source's game process is attached", [({"source": source.name}, int(source.game.watches is not None)) for source in sources])
+            quantiles = []
+            for source in sources:
+                for stage, values in source.stats.summary().items():
+                    for quantile, key in (("0.5", "p50_ms"), ("0.99", "p99_ms"), ("1", "max_ms")):
+                        if values[key] is not None:
+                            quantiles.append(({"source": source.name, "stage": stage, "quantile": quantile}, values[key] / 1000))
+            add("source_latency_seconds", "gauge", "Tone change latency per source and pipeline stage", quantiles)
+        return collected
+
+    def prometheus(self):
+        """The Prometheus text exposition format."""
+        lines = []
+        for name, kind, help_text, samples in self.collect():
+            lines.append(f"# HELP rstone2midi_{name} {help_text}")
+            lines.append(f"# TYPE rstone2midi_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+                lines.append(f"rstone2midi_{name}{{{label_text}}} {value}" if label_text else f"rstone2midi_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        metrics = {}
+        for name, _, _, samples in self.collect():
+            if len(samples) == 1 and not samples[0][0]:
+                metrics[name] = samples[0][1]
+            else:
+                metrics[name] = {",".join(f"{key}={label}" for key, label in labels.items()): value for labels, value in samples}
+        return {"time": time.time(), "metrics": metrics}
+
+    def dump(self, path=METRICS_FILE):
+        try:
+            with open(path, "w") as f:
+                json.dump(self.snapshot(), f, indent=2)
+        except Exception as e:
+            metrics.count_error("metrics_file")
+            print(f"Error writing to {path}: {e}")
+
+    def start(self, address=METRICS_ADDRESS, path=METRICS_FILE, interval=METRICS_DUMP_INTERVAL):
+        """Serves /metrics on a background thread and dumps the JSON file every interval seconds."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = registry.prometheus().encode(), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = json.dumps(registry.snapshot()).encode(), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Keep scrapes out of the console
+
+        host, port = address.rsplit(":", 1)
+        server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+
+        def dump_periodically():
+            self.sample_poll_rate()
+            while True:
+                time.sleep(interval)
+                self.sample_poll_rate()
+                self.dump(path)
+
+        threading.Thread(target=dump_periodically, name="Metrics dump", daemon=True).start()
+        return server
+
+def escape_label(value):
+    """Escapes a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = MetricsRegistry()
+
+# Session recordings are a sequence of fixed-size records: perf_counter timestamp, kind, data length, value, 4 data bytes
+RECORD_STRUCT = struct.Struct("<dBBh4s")
+RECORD_START = 0  # New session; value is the format version, data the wall clock time (uint32 seconds)
+RECORD_TONE = 1  # Tone read result; value is the tone id, -1 while no song is loaded, data how many reads the previous one lasted
+RECORD_MIDI = 2  # MIDI message sent for a tone change; value is its full length, data its first 4 bytes
+RECORD_MIDI_MORE = 3  # Next 4 bytes of a longer (sysex) message
+RECORD_MIDI_OTHER = 4  # Like RECORD_MIDI, for messages sent outside a tone change (watch CCs, test slider...), not replayed
+RECORD_EARLY = 5  # Tone sent ahead of its change by the timeline (or resent when that change never came); value is the tone id, data the reads of the current one so far
+RECORD_STOP = 6  # Recording stopped; data how many reads the last tone lasted, one record per source
+RECORD_VERSION = 3
+RECORD_TONE_DATA = struct.Struct("<HBx")  # Reads, source index
+RECORD_MAX_READS = 0xFFFF
+RECORD_SOURCE_SHIFT = 3  # MIDI records keep the source index above the 3 bits of their chunk length
+RECORD_MAX_SOURCE = 0xFF >> RECORD_SOURCE_SHIFT
+RECORD_BUFFER_SIZE = 64 * 1024
+RECORD_FLUSH_INTERVAL = 1.0  # Seconds of buffered records we can lose if the app crashes
+
+class SessionRecorder:
+    """Appends tone reads and sent MIDI to a binary file through a buffered writer.
+
+    Only reads that differ from the previous one of the same source are written, so a long gig stays small; each
+    one stores how many reads the previous value lasted, so replay can run them through the tone filter again.
+    Tone and MIDI records carry the index of their source (0 unless several are monitored).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "ab", buffering=RECORD_BUFFER_SIZE)
+        self.records = 0
+        self.last_tone_ids = {}  # Source index -> last tone read
+        self.tone_reads = {}  # Source index -> consecutive reads of that tone so far
+        self.midi_kind = RECORD_MIDI  # Set by record_sends_as()
+        self.midi_source = 0
+        self._next_flush = time.perf_counter() + RECORD_FLUSH_INTERVAL
+        self._write(RECORD_START, 4, RECORD_VERSION, struct.pack("<I", int(time.time()) & 0xFFFFFFFF))
+
+    def _write(self, kind, length, value, data=b""):
+        now = time.perf_counter()
+        with self.lock:
+            if self.file is None:
+                return  # Closed while the engine thread was still running
+            self.file.write(RECORD_STRUCT.pack(now, kind, length, value, data))
+            self.records += 1
+            if now >= self._next_flush:
+                self.file.flush()
+                self._next_flush = now + RECORD_FLUSH_INTERVAL
+
+    def record_tone(self, tone_id, source=0):
+        if source in self.last_tone_ids and tone_id == self.last_tone_ids[source]:
+            self.tone_reads[source] = min(self.tone_reads[source] + 1, RECORD_MAX_READS)
+            return
+        self._write(RECORD_TONE, 0, -1 if tone_id is None else tone_id, RECORD_TONE_DATA.pack(self.tone_reads.get(source, 0), source))
+        self.last_tone_ids[source] = tone_id
+        self.tone_reads[source] = 1
+
+    def record_early(self, tone_id, source=0):
+        self._write(RECORD_EARLY, 0, tone_id, RECORD_TONE_DATA.pack(self.tone_reads.get(source, 0), source))
+
+    def record_midi(self, message):
+        message = bytes(message)
+        self._write(self.midi_kind, min(len(message), 4) | self.midi_source << RECORD_SOURCE_SHIFT, len(message), message[:4])
+        for i in range(4, len(message), 4):
+            chunk = message[i:i + 4]
+            self._write(RECORD_MIDI_MORE, len(chunk), 0, chunk)
+
+    def close(self):
+        for source, reads in sorted(self.tone_reads.items()):
+            self._write(RECORD_STOP, 0, 0, RECORD_TONE_DATA.pack(reads, source))
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+session_recorder = None  # The active SessionRecorder, if any
+
+def start_recording(path):
+    global session_recorder
+    session_recorder = SessionRecorder(path)
+    return session_recorder
+
+def stop_recording():
+    global session_recorder
+    recorder, session_recorder = session_recorder, None
+    if recorder is not None:
+        recorder.close()
+
+def record_sends_as(kind, source=0):
+    """Tags the MIDI recorded from now on: RECORD_MIDI for tone changes, RECORD_MIDI_OTHER for everything else."""
+    if session_recorder is not None:
+        session_recorder.midi_kind = kind
+        session_recorder.midi_source = source
+
+def source_index(source):
+    """The index a source is recorded under: 0 for the single source loops, sources past 31 share the last one."""
+    return 0 if source is None else min(source.index, RECORD_MAX_SOURCE)
+
+def send_tone_untracked(tone_id, mapping, midi_out):
+    """send_tone for sends that are not a tone change read from the game (test slider, resend, timeline)."""
+    record_sends_as(RECORD_MIDI_OTHER)
+    try:
+        return send_tone(tone_id, mapping, midi_out)
+    finally:
+        record_sends_as(RECORD_MIDI)
+
+def read_recording(path):
+    """Yields (timestamp, kind, value) for every record; MIDI records come back whole.
+
+    Values: (message bytes, source) for MIDI, (tone id, reads of the previous tone, source) for tone reads,
+    (tone id, reads of the current tone so far, source) for early sends and (reads of the last tone, source)
+    for stops. 0 reads means unknown (older recordings).
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < RECORD_STRUCT.size or RECORD_STRUCT.unpack_from(data, 0)[1] != RECORD_START:
+        raise ValueError(f"{path} is not a session recording")
+    pending = None  # A MIDI message still waiting for its RECORD_MIDI_MORE records
+    for offset in range(0, len(data) - RECORD_STRUCT.size + 1, RECORD_STRUCT.size):
+        timestamp, kind, length, value, chunk = RECORD_STRUCT.unpack_from(data, offset)
+        if kind == RECORD_MIDI_MORE:
+            if pending is not None:
+                pending[2] += chunk[:length]
+                continue
+        if pending is not None:
+            yield pending[0], pending[1], (bytes(pending[2]), pending[3])
+            pending = None
+        if kind in (RECORD_MIDI, RECORD_MIDI_OTHER):
+            source = length >> RECORD_SOURCE_SHIFT
+            pending = [timestamp, kind, bytearray(chunk[:length & ((1 << RECORD_SOURCE_SHIFT) - 1)]), source]
+            if value <= 4:
+                yield timestamp, kind, (bytes(pending[2]), source)
+                pending = None
+        elif kind == RECORD_TONE:
+            yield timestamp, RECORD_TONE, (None if value < 0 else value,) + RECORD_TONE_DATA.unpack(chunk)
+        elif kind == RECORD_EARLY:
+            yield timestamp, RECORD_EARLY, (value,) + RECORD_TONE_DATA.unpack(chunk)
+        elif kind == RECORD_STOP:
+            yield timestamp, RECORD_STOP, RECORD_TONE_DATA.unpack(chunk)
+        elif kind == RECORD_START:
+            yield timestamp, RECORD_START, struct.unpack("<I", chunk)[0]
+    if pending is not None:
+        yield pending[0], pending[1], (bytes(pending[2]), pending[3])
+
+def replay_read_times(start, end, reads, tone_filter):
+    """When the reads of one recorded run of equal tone reads happened, spread evenly until the next record.
+
+    A run of unknown length (the app crashed, or an older recording) counts as held long enough to commit.
+    """
+    if not reads:
+        return [start] * (tone_filter.confirm_reads - 1) + [start + tone_filter.debounce]
+    step = (end - start) / reads
+    return (start + i * step for i in range(reads))
+
+def replay_recording(path, mapping, midi_out, q, speed=1.0, stop_event=None, new_filter=None, routes=None):
+    """Feeds the recorded tone reads back through the tone filter and send_tone, in real time or speed times faster.
+
+    Each source replays with its own filter; routes maps a source index to its (mapping, midi_out), the others
+    use mapping and midi_out. new_filter makes the ToneFilters (the settings file's by default). Messages recorded
+    outside a tone change are not replayed nor compared. Returns counts of the replayed tone changes and of the
+    messages that differ from the ones recorded.
+    """
+    if new_filter is None:
+        new_filter = lambda: open_tone_filter(q)
+    if routes is None:
+        routes = {}
+    stats = {"sessions": 0, "tone_changes": 0, "sent": 0, "recorded": 0, "mismatches": 0}
+    states = {}  # Source index -> its replay state, for the current session
+    replay_start = session_start = None
+
+    def source_state(source):
+        if source not in states:
+            source_mapping, source_midi_out = routes.get(source, (mapping, midi_out))
+            states[source] = {
+                "mapping": source_mapping, "midi_out": source_midi_out, "filter": new_filter(), "last_tone_id": None,
+                "run": None,  # [timestamp, tone id, reads replayed] of the last recorded read
+                "recorded": [], "replayed": [],  # MIDI of this session, compared when it ends
+            }
+        return states[source]
+
+    def compare():
+        for state in states.values():
+            recorded_midi, replayed_midi = state["recorded"], state["replayed"]
+            stats["recorded"] += len(recorded_midi)
+            stats["mismatches"] += sum(1 for a, b in zip(recorded_midi, replayed_midi) if a != b) + abs(len(recorded_midi) - len(replayed_midi))
+        states.clear()
+
+    def play_run(state, end, reads, keep=False):
+        """Replays the reads of the source's pending run, now that the next record tells how long it lasted.
+
+        With keep, reads is only how many it had so far: those are replayed and the run stays pending.
+        """
+        if state["run"] is None or (keep and not reads):
+            return
+        start, tone_id, replayed = state["run"]
+        state["run"] = [end, tone_id, reads] if keep else None
+        if reads:
+            reads -= replayed
+            if reads <= 0:
+                return
+        tone_filter = state["filter"]
+        source_mapping = state["mapping"]
+        for read_time in replay_read_times(start, end, reads, tone_filter):
+            delay = replay_start + (read_time - session_start) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            committed = tone_filter.update(tone_id, read_time)
+            if committed is not None and committed != state["last_tone_id"]:
+                stats["tone_changes"] += 1
+                if not tone_filter.is_redundant(source_mapping.messages[committed]):
+                    poll_start = time.perf_counter()
+                    description = send_tone(committed, source_mapping, state["midi_out"], latency_stats, poll_start)
+                    if description is not None:
+                        state["replayed"].extend(source_mapping.messages[committed])
+                        stats["sent"] += len(source_mapping.messages[committed])
+                        q.put((description, poll_start))
+            state["last_tone_id"] = committed
+            if committed == tone_id:
+                break  # More reads of the committed tone change nothing
+
+    def end_session(end):
+        for state in states.values():
+            play_run(state, end, 0)
+        compare()
+
+    for timestamp, kind, value in read_recording(path):
+        if stop_event is not None and stop_event.is_set():
+            break
+        if kind == RECORD_START:
+            end_session(timestamp)
+            stats["sessions"] += 1
+            q.put(f"Replaying session recorded {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(value))}")
+            replay_start, session_start = time.perf_counter(), timestamp
+        elif kind == RECORD_MIDI:
+            message, source = value
+            source_state(source)["recorded"].append(message)
+        elif kind == RECORD_EARLY:
+            tone_id, reads, source = value
+            state = source_state(source)
+            play_run(state, timestamp, reads, keep=True)  # The filter sees the reads before the early send, like it did live
+            if tone_id < MAPPING_SIZE:
+                state["filter"].is_redundant(state["mapping"].messages[tone_id])  # The game's own switch to it is then skipped
+        elif kind == RECORD_TONE:
+            tone_id, previous_reads, source = value
+            state = source_state(source)
+            play_run(state, timestamp, previous_reads)
+            state["run"] = [timestamp, tone_id, 0]
+        elif kind == RECORD_STOP:
+            reads, source = value
+            play_run(source_state(source), timestamp, reads)
+    if stop_event is None or not stop_event.is_set():
+        end_session(time.perf_counter())
+    else:
+        compare()
+    return stats
 
 CONFIG_FILE = "RSTone2MIDI_config.txt"
 
+# ***REPLACE THESE WITH YOUR ACTUAL VALUES***
+BASE_POINTER_OFFSET = 0xF5F54C  # Replace with your actual base pointer offset
+TONE_OFFSETS = [
+    0x10,
+    0x28,
+    0x38,
+    0x18,
+    0x04,
+    0xBC,
+    0x10
+]
+TONE_VALID_RANGE = (0, 127)  # Anything outside this is a stale or half-built chain
+
 def read_config():
-    """Reads MIDI port and message type from config file."""
+    """Reads MIDI ports and message type from config file.
+
+    The first line holds one port number, or several separated by commas to send to all of them.
+    """
     try:
         with open(CONFIG_FILE, "r") as f:
             lines = f.readlines()
             if len(lines) >= 2:  # Ensure both port and message type are present
                 try:
-                    port = int(lines[0].strip())
+                    ports = [int(port) for port in lines[0].split(",")]
                     message_type = lines[1].strip().lower()  # Store message type as lowercase
-                    return port, message_type
+                    return ports, message_type
                 except ValueError:
                     print(f"Invalid data in {CONFIG_FILE}. Please correct it.")
                     return None, None
@@ -111,152 +1251,1882 @@ def read_config():
     except FileNotFoundError:
         return None, None  # File doesn't exist
 
-def write_config(port, message_type):
-    """Writes MIDI port and message type to config file."""
+def write_config(ports, message_type):
+    """Writes MIDI ports and message type to config file."""
+    if isinstance(ports, int):
+        ports = [ports]
     try:
         with open(CONFIG_FILE, "w") as f:
-            f.write(f"{port}\n{message_type}")  # Write both port and message type
+            f.write(f"{','.join(str(port) for port in ports)}\n{message_type}")  # Write both ports and message type
     except Exception as e:
+        metrics.count_error("config_file")
         print(f"Error writing to {CONFIG_FILE}: {e}")
 
+SETTINGS_FILE = "RSTone2MIDI_settings.json"
+SETTINGS_RELOAD_INTERVAL = 1.0  # Seconds between checks of the settings file's mtime
+MAPPING_SIZE = TONE_VALID_RANGE[1] + 1  # One slot per possible tone id
+
+def read_settings(path=SETTINGS_FILE):
+    """Reads the optional JSON settings file ({} if there is none)."""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+"""
+The "tones" section of the settings file maps a tone id to the messages sent when the game switches to it, e.g.
+{
+    "tones": {
+        "0": [{"type": "program_change", "channel": 1, "program": 0}],
+        "1": [{"type": "bank_select", "channel": 1, "bank": 2},
+              {"type": "program_change", "channel": 1, "program": 5},
+              {"type": "control_change", "channel": 2, "control": 7, "value": 100}],
+        "2": [{"type": "sysex", "data": "F0 7F 7F 04 01 00 7F F7"}]
+    }
+}
+Tone ids that are not listed send nothing.
+"""
+
+def _midi_value(message, key, low=0, high=127):
+    value = int(message[key])
+    if not low <= value <= high:
+        raise ValueError(f"{key} {value} is out of range {low}-{high}")
+    return value
+
+def encode_midi_message(message):
+    """Turns one mapping entry into its (encoded messages, description) pair."""
+    message_type = message.get("type", "").lower().replace(" ", "_")
+    if message_type not in ("program_change", "control_change", "bank_select", "sysex"):
+        raise ValueError(f"Unknown message type '{message.get('type')}'")
+    if message_type == "sysex":
+        data = message["data"]
+        if isinstance(data, str):
+            data = bytes.fromhex(data)
+        data = bytes(data)
+        if len(data) < 2 or data[0] != 0xF0 or data[-1] != 0xF7:
+            raise ValueError("SysEx data must start with F0 and end with F7")
+        return [data], f"Sent MIDI SysEx: {data.hex(' ').upper()}"
+
+    channel = _midi_value(message, "channel", 1, 16)
+    if message_type == "program_change":
+        program = _midi_value(message, "program")
+        return [bytes((0xC0 | (channel - 1), program))], f"Sent MIDI Program Change: Channel {channel}, Program {program}"
+    if message_type == "control_change":
+        control = _midi_value(message, "control")
+        value = _midi_value(message, "value")
+        return [bytes((0xB0 | (channel - 1), control, value))], f"Sent MIDI Control Change: Channel {channel}, Control {control}, Value {value}"
+    bank = _midi_value(message, "bank", 0, 16383)
+    status = 0xB0 | (channel - 1)
+    return [bytes((status, 0, bank >> 7)), bytes((status, 32, bank & 0x7F))], f"Sent MIDI Bank Select: Channel {channel}, Bank {bank}"
+
+def default_tone_mapping(message_type, channel=1):
+    """The original behaviour: tone 5 sends 0, every other tone its own id, on channel 1 (or the given one) / control 1."""
+    tones = {}
+    for tone_id in range(MAPPING_SIZE):
+        value = 0 if tone_id == 5 else tone_id
+        if message_type == "control change":
+            tones[tone_id] = [{"type": "control_change", "channel": channel, "control": 1, "value": value}]
+        elif message_type == "program change":
+            tones[tone_id] = [{"type": "program_change", "channel": channel, "program": value}]
+    return tones
+
+def compile_tone_mapping(tones):
+    """Compiles {tone id: [messages]} into tables indexed by tone id: encoded messages and a log line."""
+    messages = [()] * MAPPING_SIZE
+    descriptions = [None] * MAPPING_SIZE
+    for tone_id, entries in tones.items():
+        tone_id = int(tone_id)
+        if not 0 <= tone_id < MAPPING_SIZE:
+            raise ValueError(f"Tone id {tone_id} is out of range 0-{MAPPING_SIZE - 1}")
+        encoded = []
+        lines = []
+        for entry in entries:
+            try:
+                entry_messages, description = encode_midi_message(entry)
+            except KeyError as e:
+                raise ValueError(f"Tone {tone_id}: missing {e} in {entry}")
+            except ValueError as e:
+                raise ValueError(f"Tone {tone_id}: {e}")
+            encoded.extend(entry_messages)
+            lines.append(description)
+        messages[tone_id] = tuple(encoded)
+        descriptions[tone_id] = "\n".join(lines) if lines else None
+    return messages, descriptions
+
+class ToneMapping:
+    """Tone id -> ready-to-send MIDI bytes, compiled once and recompiled when the settings file changes."""
+
+    def __init__(self, message_type, path=SETTINGS_FILE, source=None, channel=1):
+        self.message_type = message_type  # Used when the settings file has no "tones" section
+        self.path = path  # None keeps the default mapping
+        self.source = source  # Name of an entry in "sources" to take the "tones" from, instead of the top level
+        self.channel = channel  # Of the default mapping
+        self.mtime = None
+        self.reloads = 0
+        self.error = None
+        self._next_check = 0.0
+        self.messages, self.descriptions = compile_tone_mapping(default_tone_mapping(message_type, channel))
+        self.reload_if_changed()
+
+    def reload_if_changed(self):
+        """Recompiles the table if the settings file changed. Returns True if it was (re)loaded or failed to."""
+        if self.path is None:
+            return False
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+
+        try:
+            tones = default_tone_mapping(self.message_type, self.channel)
+            if mtime is not None:
+                with open(self.path, "r") as f:
+                    settings = json.load(f)
+                if self.source is not None:
+                    settings = next((entry for entry in settings.get("sources", []) if entry.get("name") == self.source), {})
+                tones = settings.get("tones", tones)
+            # Swap both tables in one assignment so the poll loop never sees a half-built mapping
+            self.messages, self.descriptions = compile_tone_mapping(tones)
+            self.error = None
+        except Exception as e:
+            self.error = f"Error loading {self.path}: {e}"  # Keep sending with the previous table
+        self.reloads += 1
+        return True
+
+    def set_message_type(self, message_type):
+        """Switches the default mapping's message type and recompiles right away."""
+        self.message_type = message_type
+        self.mtime = -1  # Forces reload_if_changed() to recompile
+        if self.path is None:
+            self.messages, self.descriptions = compile_tone_mapping(default_tone_mapping(message_type, self.channel))
+        else:
+            self.reload_if_changed()
+
+    def maybe_reload(self):
+        """Cheap enough to call every tick: only stats the file once per SETTINGS_RELOAD_INTERVAL."""
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + SETTINGS_RELOAD_INTERVAL
+        return self.reload_if_changed()
+
+def send_tone(tone_id, mapping, midi_out, stats=None, poll_start=None):
+    """Sends every message mapped to tone_id. Returns the log line for it (None if nothing is mapped).
+
+    With stats, records the "message sent" latency since poll_start: on a MidiOutputEngine that is when its
+    port threads have called the drivers, not when the messages were queued.
+    """
+    messages = mapping.messages[tone_id]
+    if isinstance(midi_out, MidiOutputEngine):
+        if messages:
+            midi_out.send_messages(messages, stats, poll_start)  # One datagram per tone change on network outputs
+        return mapping.descriptions[tone_id]
+    if hasattr(midi_out, "send_messages"):
+        if messages:
+            midi_out.send_messages(messages)
+    else:
+        for message in messages:
+            midi_out.send_message(message)
+    if stats is not None and messages:
+        stats.record(STAGE_SEND, time.perf_counter() - poll_start)
+    return mapping.descriptions[tone_id]
+
+WATCH_TYPES = {
+    "int8": "<b", "uint8": "<B",
+    "int16": "<h", "uint16": "<H",
+    "int32": "<i", "uint32": "<I",
+    "float": "<f", "double": "<d",
+    "string": "<32s",  # NUL terminated ASCII, e.g. the song key
+}
+WATCH_BULK_GAP = 64  # Fields of one object closer than this are fetched with one read
+WATCH_BULK_MAX = 4096  # Largest single bulk read
+
+class Watch:
+    """One value to follow in game memory: a pointer chain, a type and a change threshold."""
+
+    def __init__(self, name, base_pointer_offset, offsets, value_type="int32", threshold=0, valid_range=None, control_change=None):
+        if value_type not in WATCH_TYPES:
+            raise ValueError(f"Watch '{name}': unknown type '{value_type}'")
+        if not offsets:
+            raise ValueError(f"Watch '{name}': needs at least one offset")
+        if value_type == "string" and (threshold or valid_range is not None or control_change is not None):
+            raise ValueError(f"Watch '{name}': a string has no threshold, range or control_change")
+        self.name = name
+        self.base_pointer_offset = base_pointer_offset
+        self.offsets = list(offsets)
+        self.value_type = value_type
+        self.format = struct.Struct(WATCH_TYPES[value_type])
+        self.threshold = threshold  # Smaller changes than this are not reported
+        self.valid_range = valid_range  # (min, max), values outside it mean the chain is stale
+        self.control_change = None  # (status, control, min, max) when the value is sent as a CC
+        self.last_cc = None
+        if control_change is not None:
+            channel = _midi_value(control_change, "channel", 1, 16)
+            control = _midi_value(control_change, "control")
+            low = control_change.get("min", 0)
+            high = control_change.get("max", 127)
+            if high == low:
+                raise ValueError(f"Watch '{name}': control_change min and max must differ")
+            self.control_change = (0xB0 | (channel - 1), control, low, high)
+
+    def cc_value(self, value):
+        """Scales a value from the watch's min-max range to 0-127."""
+        _, _, low, high = self.control_change
+        return max(0, min(127, round((value - low) * 127 / (high - low))))
+
+    @property
+    def parent_path(self):
+        """The pointers to follow to reach the object holding this value."""
+        return (self.base_pointer_offset,) + tuple(self.offsets[:-1])
+
+def default_watches(base_pointer_offset=BASE_POINTER_OFFSET):
+    return [Watch("tone", base_pointer_offset, TONE_OFFSETS, valid_range=TONE_VALID_RANGE)]
+
+def load_watches(path=SETTINGS_FILE, base_pointer_offset=BASE_POINTER_OFFSET):
+    """Reads the "watches" section of the settings file; the tone watch is always present.
+
+    Each entry looks like {"name": "song_time", "base": "0xF5C5AC", "offsets": ["0xB0", "0x538", "0x8"],
+    "type": "float", "threshold": 0.05}. Numbers may be given as ints or hex strings.
+    Add "control_change": {"channel": 1, "control": 11, "min": 0, "max": 100} to send the value as a CC.
+    """
+    watches = {watch.name: watch for watch in default_watches(base_pointer_offset)}
+    entries = read_settings(path).get("watches", [])
+
+    def number(value):
+        return int(value, 0) if isinstance(value, str) else value
+
+    for entry in entries:
+        watches[entry["name"]] = Watch(
+            entry["name"],
+            number(entry["base"]),
+            [number(offset) for offset in entry["offsets"]],
+            entry.get("type", "int32"),
+            entry.get("threshold", 0),
+            entry.get("range"),
+            entry.get("control_change"),
+        )
+    return list(watches.values())
+
+class WatchList:
+    """Reads every watch in one batched pass per tick and reports only the values that changed.
+
+    Pointer prefixes shared by several watches are resolved once and cached; only the final addresses are read
+    on each tick, and the paths are walked again every revalidate_interval or when a value looks stale.
+    While some path is null only those are retried on the timer, but every full_resolve_every-th time all are.
+    Fields of the same object that sit close together are fetched with a single bulk read.
+    """
+
+    def __init__(self, reader, base_address, watches, revalidate_interval=0.25, full_resolve_every=2):
+        self.reader = reader
+        self.base_address = base_address
+        self.watches = list(watches)
+        self.revalidate_interval = revalidate_interval
+        self.full_resolve_every = full_resolve_every
+        self.values = {watch.name: None for watch in self.watches}
+        self.resolves = 0
+        self.ticks = 0
+        self.total_reads = 0
+        self.last_tick_reads = 0
+        self.read_failures = 0
+        self.null_chains = 0  # Walks that stopped at a null pointer (menus, song loads)
+        self._next_revalidate = 0.0
+        self._partial_resolves = 0  # Timer resolves of the null paths only, since the last full one
+
+        # Every distinct pointer path, parents before children, so shared prefixes are read once
+        paths = set()
+        for watch in self.watches:
+            path = watch.parent_path
+            for length in range(1, len(path) + 1):
+                paths.add(path[:length])
+        self._paths = sorted(paths, key=len)
+        self._pointers = {}
+        self._incomplete = True  # Some watched object is behind a null pointer
+
+        # Per parent object: clusters of nearby fields, each fetched with one read
+        groups = {}
+        for watch in self.watches:
+            groups.setdefault(watch.parent_path, []).append(watch)
+        self._clusters = []  # (parent path, first offset, size, [(watch, offset in cluster)])
+        for path, members in groups.items():
+            members.sort(key=lambda watch: watch.offsets[-1])
+            cluster = []
+            for watch in members:
+                start = watch.offsets[-1]
+                end = start + watch.format.size
+                if cluster:
+                    cluster_start = cluster[0].offsets[-1]
+                    cluster_end = max(w.offsets[-1] + w.format.size for w in cluster)
+                    if start - cluster_end > WATCH_BULK_GAP or end - cluster_start > WATCH_BULK_MAX:
+                        self._add_cluster(path, cluster)
+                        cluster = []
+                cluster.append(watch)
+            self._add_cluster(path, cluster)
+
+    def _add_cluster(self, path, cluster):
+        start = cluster[0].offsets[-1]
+        size = max(watch.offsets[-1] + watch.format.size for watch in cluster) - start
+        self._clusters.append((path, start, size, [(watch, watch.offsets[-1] - start) for watch in cluster]))
+
+    def resolve(self, incomplete_only=False):
+        """Walks every distinct pointer path once (None where a pointer is null or unreadable).
+
+        With incomplete_only, only the paths that were null last time are walked, the resolved ones are kept.
+        """
+        self.resolves += 1
+        pointers = dict(self._pointers) if incomplete_only else {}
+        for path in self._paths:
+            if incomplete_only and pointers.get(path) is not None:
+                continue
+            if len(path) == 1:
+                address = self.base_address + path[0]
+            else:
+                parent = pointers[path[:-1]]
+                address = None if parent is None else parent + path[-1]
+            value = None
+            if address is not None:
+                try:
+                    value = self.reader.read_int(address) or None
+                except Exception:
+                    self.read_failures += 1
+                    value = None
+            pointers[path] = value
+        self._pointers = pointers
+        self._incomplete = any(pointers[path] is None for path, _, _, _ in self._clusters)
+        if self._incomplete:
+            self.null_chains += 1
+        self._next_revalidate = time.monotonic() + self.revalidate_interval
+
+    def _read_values(self):
+        """Reads every cluster. Returns ({name: value}, stale) where stale means a read failed or looked invalid."""
+        values = {}
+        stale = False
+        for path, start, size, members in self._clusters:
+            parent = self._pointers.get(path)
+            if parent is None:
+                for watch, _ in members:
+                    values[watch.name] = None
+                continue
+            try:
+                data = self.reader.read_bytes(parent + start, size)
+            except Exception:
+                self.read_failures += 1
+                data = None
+            for watch, offset in members:
+                value = None
+                if data is not None:
+                    value = watch.format.unpack_from(data, offset)[0]
+                    if watch.value_type == "string":
+                        value = value.split(b"\0", 1)[0].decode("latin-1")
+                    elif watch.valid_range is not None and not (watch.valid_range[0] <= value <= watch.valid_range[1]):
+                        value = None
+                if value is None:
+                    stale = True
+                values[watch.name] = value
+        return values, stale
+
+    def poll(self):
+        """Reads all watches once and returns {name: value} for those that changed past their threshold."""
+        reads_before = self.reader.reads
+
+        if time.monotonic() >= self._next_revalidate:
+            # Null paths (e.g. a song-only watch while in the menus) are retried here rather than on every tick,
+            # and the resolved ones are only walked every full_resolve_every-th time, so they still follow a new song
+            partial = self._incomplete and self._partial_resolves + 1 < self.full_resolve_every
+            self._partial_resolves = self._partial_resolves + 1 if partial else 0
+            self.resolve(incomplete_only=partial)
+            values, stale = self._read_values()
+        else:
+            values, stale = self._read_values()
+            if stale:
+                # The cached pointers may be out of date (e.g. a new song was loaded), walk them again
+                self.resolve()
+                values, stale = self._read_values()
+
+        changes = {}
+        for watch in self.watches:
+            old = self.values[watch.name]
+            new = values[watch.name]
+            if old is None or new is None:
+                changed = old is not new
+            else:
+                changed = new != old and (not watch.threshold or abs(new - old) >= watch.threshold)
+            if changed:
+                changes[watch.name] = new
+                self.values[watch.name] = new
+
+        self.last_tick_reads = self.reader.reads - reads_before
+        self.total_reads += self.last_tick_reads
+        self.ticks += 1
+        return changes
+
+    @property
+    def syscalls_per_tick(self):
+        return self.total_reads / self.ticks if self.ticks else 0.0
+
+def send_watch_changes(changes, watches, midi_out):
+    """Sends the CCs of changed watches that are mapped to one (e.g. a note streak driving an expression CC)."""
+    for watch in watches.watches:
+        if watch.control_change is None or changes.get(watch.name) is None:
+            continue
+        cc = watch.cc_value(changes[watch.name])
+        if cc != watch.last_cc:
+            record_sends_as(RECORD_MIDI_OTHER)
+            try:
+                midi_out.send_message(bytes((watch.control_change[0], watch.control_change[1], cc)))
+            finally:
+                record_sends_as(RECORD_MIDI)
+            watch.last_cc = cc
+
+TIMELINE_CACHE_FILE = "RSTone2MIDI_timeline_cache.json"
+TIMELINE_LEAD = 0.15  # Seconds before a tone change to send its MIDI, about the preset load time of a heavy amp sim
+TIMELINE_ARRANGEMENT = "lead"
+TIMELINE_EXTENSIONS = (".xml", ".psarc")
+
+def parse_arrangement(data):
+    """Reads an arrangement XML. Returns (arrangement name, [(seconds, tone_id)]) with the base tone at 0."""
+    root = ElementTree.fromstring(data)
+    if root.tag.lower() != "song":
+        raise ValueError("not an arrangement")
+    fields = {child.tag.lower(): (child.text or "").strip() for child in root}
+    tone_names = [fields.get(slot, "") for slot in ("tonea", "toneb", "tonec", "toned")]
+
+    def tone_id(name):
+        return tone_names.index(name) if name and name in tone_names else 0
+
+    events = [(0.0, tone_id(fields.get("tonebase")))]
+    for tones in root:
+        if tones.tag.lower() != "tones":
+            continue
+        for tone in tones:
+            if "id" in tone.attrib:
+                events.append((float(tone.attrib["time"]), int(tone.attrib["id"])))
+            else:
+                events.append((float(tone.attrib["time"]), tone_id(tone.attrib.get("name"))))
+    events.sort()
+    return fields.get("arrangement", "").lower(), events
+
+def read_psarc(path):
+    """Yields (name, data) for the XML files in a PSARC archive.
+
+    Archives with an encrypted table of contents (all official DLC) are rejected; their
+    arrangements are only stored as encrypted SNG, extract the XML with the toolkit instead.
+    """
+    with open(path, "rb") as f:
+        magic, _, compression, toc_length, entry_size, entry_count, block_size, flags = struct.unpack(">4sI4sIIIII", f.read(32))
+        if magic != b"PSAR" or compression != b"zlib":
+            raise ValueError("not a PSARC archive")
+        if flags & 4:
+            raise ValueError("encrypted archive, extract its arrangement XML files instead")
+        toc = f.read(toc_length - 32)
+        entries = []
+        for i in range(entry_count):
+            entry = toc[i * entry_size:(i + 1) * entry_size]
+            entries.append((struct.unpack(">I", entry[16:20])[0], int.from_bytes(entry[20:25], "big"), int.from_bytes(entry[25:30], "big")))
+        width = (block_size.bit_length() + 6) // 8  # Bytes per block length, 2 for 64 KB blocks
+        table = toc[entry_count * entry_size:]
+        block_lengths = [int.from_bytes(table[i:i + width], "big") for i in range(0, len(table) - width + 1, width)]
+
+        def read_entry(block, length, offset):
+            f.seek(offset)
+            data = bytearray()
+            while len(data) < length:
+                if block_lengths[block] == 0:
+                    data += f.read(block_size)  # A full block stored uncompressed
+                else:
+                    chunk = f.read(block_lengths[block])
+                    try:
+                        data += zlib.decompress(chunk)
+                    except zlib.error:
+                        data += chunk  # Stored as is because it didn't compress
+                block += 1
+            return bytes(data[:length])
+
+        names = read_entry(*entries[0]).decode("utf-8").split("\n")  # Entry 0 lists the names of the others
+        for name, entry in zip(names, entries[1:]):
+            if name.lower().endswith(".xml"):
+                yield name, read_entry(*entry)
+
+def index_song_file(path):
+    """Tone timelines of one song file, as {song key: {arrangement: [[seconds, tone_id], ...]}}.
+
+    The song key is taken from the file name, e.g. "songs/arr/mysong_lead.xml" is song "mysong".
+    """
+    if path.lower().endswith(".psarc"):
+        files = read_psarc(path)
+    else:
+        with open(path, "rb") as f:
+            files = [(path, f.read())]
+    songs = {}
+    for name, data in files:
+        try:
+            arrangement, events = parse_arrangement(data)
+        except (ValueError, ElementTree.ParseError):
+            continue  # Showlights, vocals and other XML files
+        stem = os.path.splitext(os.path.basename(name))[0].lower()
+        song_key = stem.rsplit("_", 1)[0] if "_" in stem else stem
+        songs.setdefault(song_key, {})[arrangement or stem.rsplit("_", 1)[-1]] = [list(event) for event in events]
+    return songs
+
+class TimelineLibrary:
+    """Tone timelines of every song file in a folder, parsed once and cached by file size and timestamp."""
+
+    def __init__(self, folder, cache_file=TIMELINE_CACHE_FILE):
+        self.folder = folder
+        self.cache_file = cache_file
+        self.songs = {}  # song key -> {arrangement: [(seconds, tone_id)]}
+        self.ready = False
+        self.files = 0
+        self.parsed = 0
+        self.errors = []
+
+    def load(self):
+        """Indexes the folder, parsing only the files that are new or changed since the last run."""
+        try:
+            with open(self.cache_file, "r") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        entries = {}
+        for directory, _, names in os.walk(self.folder):
+            for name in names:
+                if not name.lower().endswith(TIMELINE_EXTENSIONS):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entry = cache.get(path)
+                if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                    entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "songs": {}}
+                    self.parsed += 1
+                    try:
+                        entry["songs"] = index_song_file(path)
+                    except Exception as e:
+                        self.errors.append(f"{path}: {e}")  # Cached empty, so it isn't opened again until it changes
+                entries[path] = entry
+        self.files = len(entries)
+
+        songs = {}
+        for entry in entries.values():
+            for song_key, arrangements in entry["songs"].items():
+                for arrangement, events in arrangements.items():
+                    songs.setdefault(song_key, {})[arrangement] = [tuple(event) for event in events]
+        self.songs = songs
+        self.ready = True
+
+        if self.parsed or len(entries) != len(cache):
+            try:
+                with open(self.cache_file, "w") as f:
+                    json.dump(entries, f)
+            except Exception as e:
+                metrics.count_error("timeline_cache")
+                print(f"Error writing to {self.cache_file}: {e}")
+
+    def start(self, q):
+        """Loads the library on a background thread, so a first run over thousands of songs doesn't hold up polling."""
+        def load():
+            start = time.perf_counter()
+            self.load()
+            q.put(f"Tone timelines: {len(self.songs)} song(s) from {self.files} file(s), {self.parsed} parsed, "
+                  f"{len(self.errors)} skipped ({time.perf_counter() - start:.1f} s).")
+        thread = threading.Thread(target=load)
+        thread.daemon = True
+        thread.start()
+
+    def get(self, song_key, arrangement=TIMELINE_ARRANGEMENT):
+        arrangements = self.songs.get(song_key.lower())
+        if not arrangements:
+            return None
+        return arrangements.get(arrangement) or (next(iter(arrangements.values())) if len(arrangements) == 1 else None)
+
+class ToneLookahead:
+    """Follows the song time and says which tone to send ahead of the next change in the song's timeline."""
+
+    def __init__(self, library, lead=TIMELINE_LEAD, arrangement=TIMELINE_ARRANGEMENT):
+        self.library = library
+        self.lead = lead
+        self.arrangement = arrangement
+        self.song_key = None
+        self.events = None
+        self.times = []
+        self.next_index = 0
+        self.last_time = None
+        self.early_sends = 0
+        self.pending = None  # Tone sent early whose change the game has not made yet
+        self.abandoned = False  # Set when the song changed or went back before that change: the amp needs the current tone again
+        self.abandoned_sends = 0
+
+    def _abandon(self):
+        if self.pending is not None:
+            self.pending = None
+            self.abandoned = True
+            self.abandoned_sends += 1
+
+    def update(self, song_key, song_time):
+        """Returns (tone_id, seconds until the change) when it is time to send a tone early, else None."""
+        if song_key != self.song_key:
+            self._abandon()  # Quit or changed song
+        if song_key != self.song_key or self.events is None and song_key and self.library.ready:
+            self.song_key = song_key
+            self.events = self.library.get(song_key, self.arrangement) if song_key and self.library.ready else None
+            self.times = [at for at, _ in self.events] if self.events else []
+            self.last_time = None
+        if not self.events or song_time is None:
+            return None
+        if self.last_time is not None and song_time < self.last_time:
+            self._abandon()  # Restart, rewind or riff repeater loop
+        if self.last_time is None or song_time < self.last_time:
+            # New song, restart or rewind: only changes from here on are still ahead
+            self.next_index = bisect.bisect_right(self.times, song_time)
+        self.last_time = song_time
+        while self.next_index < len(self.times) and self.times[self.next_index] <= song_time:
+            self.next_index += 1  # Passed without being sent early (e.g. a lead shorter than a tick); the game's switch covers it
+        if self.next_index < len(self.times) and self.times[self.next_index] - song_time <= self.lead:
+            at, tone_id = self.events[self.next_index]
+            self.next_index += 1
+            self.early_sends += 1
+            self.pending = tone_id
+            return tone_id, at - song_time
+        return None
+
+def load_lookahead(q, path=SETTINGS_FILE):
+    """The ToneLookahead set up by the "timeline" section of the settings file, or None if there is none.
+
+    e.g. {"library": "C:/Program Files (x86)/Steam/steamapps/common/Rocksmith2014/dlc", "lead_ms": 150, "arrangement": "lead"}.
+    It needs "song_key" (type "string") and "song_time" (type "float", seconds) watches.
+    """
+    try:
+        settings = read_settings(path).get("timeline")
+        if settings is None:
+            return None
+        library = TimelineLibrary(settings["library"])
+        lookahead = ToneLookahead(library, float(settings.get("lead_ms", TIMELINE_LEAD * 1000)) / 1000,
+                                  settings.get("arrangement", TIMELINE_ARRANGEMENT).lower())
+    except Exception as e:
+        q.put(f"Error loading the tone timeline settings from {path}: {e}")
+        return None
+    library.start(q)
+    return lookahead
+
+def send_lookahead(lookahead, watches, mapping, midi_out, q, tone_filter, source=None):
+    """Sends the next tone of the song's timeline early; the tone filter then skips the game's own switch to it.
+
+    If the song changes or goes back before that switch, the current tone is sent again so the amp doesn't stay on
+    the early one.
+    """
+    if lookahead.pending is not None and tone_filter.tone_id == lookahead.pending:
+        lookahead.pending = None  # The game made the change
+    upcoming = lookahead.update(watches.values.get("song_key"), watches.values.get("song_time"))
+    if lookahead.abandoned:
+        lookahead.abandoned = False
+        tone_filter.last_sent = None
+        current = tone_filter.tone_id
+        if current is not None and current < MAPPING_SIZE:
+            tone_filter.last_sent = mapping.messages[current]
+            if session_recorder is not None:
+                session_recorder.record_early(current, source_index(source))  # Replay then expects it as the last sent
+            description = send_tone_untracked(current, mapping, midi_out)
+            if description is not None:
+                q.put(f"{description} (the early tone change did not happen)")
+    if upcoming is None:
+        return
+    tone_id, ahead = upcoming
+    if tone_id >= MAPPING_SIZE or tone_filter.is_redundant(mapping.messages[tone_id]):
+        return
+    if session_recorder is not None:
+        session_recorder.record_early(tone_id, source_index(source))
+    description = send_tone_untracked(tone_id, mapping, midi_out)
+    if description is not None:
+        q.put(f"{description} ({ahead * 1000:.0f} ms ahead of the tone change)")
+
+EVENT_TONE_CHANGE = "tone_change"
+EVENT_ATTACHED = "attached"
+EVENT_DETACHED = "detached"
+HOOK_EVENTS = (EVENT_TONE_CHANGE, EVENT_ATTACHED, EVENT_DETACHED)
+HOOK_WORKERS = 4  # Threads shared by all hooks
+HOOK_TIMEOUT = 1.0  # Default seconds a hook may take per event
+HOOK_MAX_PENDING = 32  # Events queued for one hook before new ones are dropped
+
+class Hook:
+    """One registered callback with its own event queue, so it sees events in order, and its timing stats."""
+
+    def __init__(self, name, event, callback, timeout=HOOK_TIMEOUT):
+        self.name = name
+        self.event = event
+        self.callback = callback
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pending = collections.deque()
+        self.scheduled = False  # A worker is draining the queue
+        self.running_since = None  # perf_counter at the start of the current call
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0  # Calls that took longer than the timeout
+        self.dropped = 0
+        self.times = RollingHistogram()
+
+    def summary(self):
+        return {"calls": self.calls, "errors": self.errors, "timeouts": self.timeouts, "dropped": self.dropped, "time": self.times.summary()}
+
+class HookRegistry:
+    """Runs user callbacks for tone changes and attach/detach on a small thread pool, never on the polling thread.
+
+    A hook can't be stopped once it runs, so one that is past its timeout gets no new events
+    (they are dropped and counted) until it returns; the other hooks keep their workers.
+    The workers are daemon threads: a hook that never returns doesn't keep the app from exiting.
+    """
+
+    def __init__(self, workers=HOOK_WORKERS, max_pending=HOOK_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.hooks = []
+        self.ready = None  # Hooks with pending events, for the workers; started with the first hook
+        self.q = None  # Where hook errors are reported, set by load_hooks()
+
+    def register(self, event, callback, timeout=HOOK_TIMEOUT, name=None):
+        """Calls callback(event) with a dict ({"event": ..., "time": ..., ...}) whenever the event happens."""
+        if event not in HOOK_EVENTS:
+            raise ValueError(f"Unknown hook event '{event}', use one of {', '.join(HOOK_EVENTS)}")
+        if self.ready is None:
+            self.ready = queue.Queue()
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f"Hook-{i}", daemon=True).start()
+        hook = Hook(name or getattr(callback, "__name__", repr(callback)), event, callback, timeout)
+        self.hooks.append(hook)
+        return hook
+
+    def on(self, event, timeout=HOOK_TIMEOUT):
+        """Decorator form of register()."""
+        def decorator(callback):
+            self.register(event, callback, timeout)
+            return callback
+        return decorator
+
+    def emit(self, event, **data):
+        """Queues the event for its hooks and returns right away."""
+        if not self.hooks:
+            return
+        data["event"] = event
+        data["time"] = time.time()
+        now = time.perf_counter()
+        for hook in self.hooks:
+            if hook.event != event:
+                continue
+            with hook.lock:
+                if hook.running_since is not None and now - hook.running_since > hook.timeout or len(hook.pending) >= self.max_pending:
+                    hook.dropped += 1
+                    continue
+                hook.pending.append(data)
+                if hook.scheduled:
+                    continue
+                hook.scheduled = True
+            self.ready.put(hook)
+
+    def _work(self):
+        while True:
+            self._drain(self.ready.get())
+
+    def _drain(self, hook):
+        while True:
+            with hook.lock:
+                if not hook.pending:
+                    hook.scheduled = False
+                    return
+                data = hook.pending.popleft()
+                hook.running_since = time.perf_counter()
+            try:
+                hook.callback(data)
+            except Exception as e:
+                hook.errors += 1
+                if hook.errors == 1 and self.q is not None:
+                    self.q.put(f"Hook {hook.name} failed on {data['event']}: {e} (further errors are only counted)")
+            elapsed = time.perf_counter() - hook.running_since
+            with hook.lock:
+                hook.running_since = None
+            hook.calls += 1
+            hook.times.add(elapsed)
+            if elapsed > hook.timeout:
+                hook.timeouts += 1
+                if hook.timeouts == 1 and self.q is not None:
+                    self.q.put(f"Hook {hook.name} took {elapsed * 1000:.0f} ms on {data['event']} (timeout {hook.timeout * 1000:.0f} ms), "
+                               "events that arrive while it is late are dropped.")
+
+    def summary(self):
+        return {hook.name: hook.summary() for hook in self.hooks}
+
+hooks = HookRegistry()
+
+def load_hooks(q, path=SETTINGS_FILE):
+    """Loads the hook scripts listed in the "hooks" section of the settings file.
+
+    Each script defines register(hooks) and registers its callbacks there, e.g.
+    def register(hooks):
+        hooks.register("tone_change", switch_obs_scene, timeout=0.5)
+    """
+    hooks.q = q
+    import importlib.util
+    for script in read_settings(path).get("hooks", []):
+        try:
+            spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(script))[0], script)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            registered = len(hooks.hooks)
+            module.register(hooks)
+            q.put(f"Loaded hook script {script} ({len(hooks.hooks) - registered} hook(s)).")
+        except Exception as e:
+            q.put(f"Error loading hook script {script}: {e}")
+
+GUI_LOG_MAX_LINES = 1000  # Older messages are dropped from the window
+
+class GuiLog:
+    """Ring buffer behind the message window: coalesces repeats and flushes new lines in one insert."""
+
+    def __init__(self, max_lines=GUI_LOG_MAX_LINES):
+        self.max_lines = max_lines
+        self.entries = collections.deque(maxlen=max_lines)  # [message, repeat count]
+        self.coalesced = 0  # Messages folded into the previous identical one
+        self._new = 0  # Entries at the tail that are not in the widget yet
+        self._tail_dirty = False  # The last entry in the widget got a new repeat count
+        self._shown_lines = collections.deque()  # Text lines each entry in the widget takes up
+
+    def add(self, message):
+        if self.entries and self.entries[-1][0] == message:
+            self.entries[-1][1] += 1
+            self.coalesced += 1
+            if self._new == 0:
+                self._tail_dirty = True
+            return
+        self.entries.append([message, 1])
+        self._new = min(self._new + 1, self.max_lines)
+
+    @staticmethod
+    def _format(entry):
+        message, count = entry
+        if count > 1:
+            return f"{message} (x{count})\n"
+        return message + "\n"
+
+    def flush(self, widget):
+        """Brings the widget up to date with a single insert. Returns False if there was nothing to do."""
+        if not self._new and not self._tail_dirty:
+            return False
+
+        start = len(self.entries) - self._new
+        widget.config(state=tk.NORMAL)
+        if self._tail_dirty and self._shown_lines:
+            widget.delete("log_tail", "end-1c")  # Re-written below with its new count
+            self._shown_lines.pop()
+            start -= 1
+        start = max(start, 0)
+
+        texts = [self._format(self.entries[i]) for i in range(start, len(self.entries))]
+        widget.insert(tk.END, "".join(texts))
+        widget.mark_set("log_tail", f"end-{len(texts[-1]) + 1}c")
+        widget.mark_gravity("log_tail", tk.LEFT)
+        self._shown_lines.extend(text.count("\n") for text in texts)
+
+        # Trim from the top so the widget never holds more than max_lines entries
+        trimmed_lines = 0
+        while len(self._shown_lines) > self.max_lines:
+            trimmed_lines += self._shown_lines.popleft()
+        if trimmed_lines:
+            widget.delete("1.0", f"{trimmed_lines + 1}.0")
+
+        widget.see(tk.END)
+        widget.config(state=tk.DISABLED)  # Read-only, so typing can't shift the line bookkeeping
+        self._new = 0
+        self._tail_dirty = False
+        return True
+
 def update_gui_messages(q):
     """Updates the message display in the GUI."""
+    poll_starts = []
     try:
         while True:
             message = q.get_nowait()
-            message_display.insert(tk.END, message + "\n")
-            message_display.see(tk.END)
+            if isinstance(message, tuple):  # (text, start of the poll that produced it)
+                message, poll_start = message
+                poll_starts.append(poll_start)
+            gui_log.add(message)
     except queue.Empty:
         pass
+    gui_log.flush(message_display)
+    for poll_start in poll_starts:
+        latency_stats.record(STAGE_GUI, time.perf_counter() - poll_start)
     root.after(100, update_gui_messages, q)  # Correct: root is now in scope
 
-def main_loop(q, window_title, module_name):
-    """The main game processing loop, running in a separate thread."""
+FILTER_CONFIRM_READS = 2  # Consecutive reads a new tone needs before it is sent
+FILTER_DEBOUNCE = 0.0  # Seconds a new tone must hold before it is sent
+
+class ToneFilter:
+    """Commits a new tone read only once it was seen on N consecutive reads and held for the debounce window.
+
+    During song loads and tone switches the pointer chain can briefly point at garbage; a value
+    that never repeats is dropped instead of making the amp sim load a bogus preset.
+    Out of range values are already turned into None by the tone watch's valid_range.
+    """
+
+    def __init__(self, confirm_reads=FILTER_CONFIRM_READS, debounce=FILTER_DEBOUNCE):
+        self.confirm_reads = max(1, confirm_reads)
+        self.debounce = debounce
+        self.tone_id = None  # The committed tone
+        self.candidate = None
+        self.last_sent = None  # Messages of the last tone that was sent
+        self.commits = 0
+        self.glitches = 0  # Candidates dropped before they were confirmed
+        self.suppressed = 0  # Tone changes not sent because they map to the messages already sent
+        self._candidate_reads = 0
+        self._candidate_since = 0.0
+
+    @property
+    def confirming(self):
+        """True while a candidate still needs more reads, so the caller can poll again right away."""
+        return 0 < self._candidate_reads < self.confirm_reads
+
+    def update(self, tone_id, now):
+        """Feeds one read. Returns the committed tone."""
+        if tone_id == self.tone_id:
+            if self._candidate_reads:
+                self.glitches += 1
+                self._candidate_reads = 0
+            return self.tone_id
+        if self._candidate_reads and tone_id == self.candidate:
+            self._candidate_reads += 1
+        else:
+            if self._candidate_reads:
+                self.glitches += 1
+            self.candidate = tone_id
+            self._candidate_reads = 1
+            self._candidate_since = now
+        if self._candidate_reads >= self.confirm_reads and now - self._candidate_since >= self.debounce:
+            self.tone_id = tone_id
+            self._candidate_reads = 0
+            self.commits += 1
+        return self.tone_id
+
+    def is_redundant(self, messages):
+        """True (and counted) if these messages were the last ones sent, e.g. the same tone after a song reload."""
+        if messages == self.last_sent:
+            self.suppressed += 1
+            return True
+        self.last_sent = messages
+        return False
+
+def load_tone_filter(path=SETTINGS_FILE):
+    """The ToneFilter set up by the "filter" section of the settings file, e.g. {"confirm_reads": 3, "debounce_ms": 5}."""
+    settings = read_settings(path).get("filter", {})
+    return ToneFilter(int(settings.get("confirm_reads", FILTER_CONFIRM_READS)),
+                      float(settings.get("debounce_ms", FILTER_DEBOUNCE * 1000)) / 1000)
+
+def poll_tone(watches, last_tone_id, mapping, midi_out, q, tone_filter=None, stats=None):
+    """Reads every watch once and sends MIDI if the tone changed. Returns the tone_id (None while no song is loaded).
+
+    With a tone_filter the returned tone_id is the filtered one. stats defaults to latency_stats.
+    """
+    if stats is None:
+        stats = latency_stats
+    poll_start = time.perf_counter()
+    changes = watches.poll()
+    stats.record(STAGE_READ, time.perf_counter() - poll_start)
+    if changes:
+        send_watch_changes(changes, watches, midi_out)
+    return update_tone(watches.values["tone"], poll_start, last_tone_id, mapping, midi_out, q, tone_filter, stats)
+
+def update_tone(tone_id, poll_start, last_tone_id, mapping, midi_out, q, tone_filter=None, stats=None, source=None, send=None):
+    """Filters one tone read and sends its MIDI if the tone changed. Returns the (filtered) tone_id.
+
+    source is the Source it was read for when several are monitored, named in the log and in hook events.
+    send(tone_id, poll_start), if given, is called instead of sending and logging here (e.g. to queue it for a dispatcher).
+    """
+    if stats is None:
+        stats = latency_stats
+    index = source_index(source)
+    if session_recorder is not None:
+        session_recorder.record_tone(tone_id, index)
+    if tone_filter is not None:
+        tone_id = tone_filter.update(tone_id, poll_start)
+    if tone_id is None or tone_id == last_tone_id:
+        return tone_id
+
+    stats.record(STAGE_DETECT, time.perf_counter() - poll_start)
+    if tone_filter is None or not tone_filter.is_redundant(mapping.messages[tone_id]):
+        if send is not None:
+            send(tone_id, poll_start)
+        else:
+            record_sends_as(RECORD_MIDI, index)
+            try:
+                description = send_tone(tone_id, mapping, midi_out, stats, poll_start)
+            finally:
+                record_sends_as(RECORD_MIDI)
+            if description is not None:
+                q.put((description if source is None else f"[{source.name}] {description}", poll_start))
+    hooks.emit(EVENT_TONE_CHANGE, tone_id=tone_id, previous_tone_id=last_tone_id, description=mapping.descriptions[tone_id],
+               source=None if source is None else source.name)
+    return tone_id
+
+def find_tone_base_pointer(reader, module, q):
+    """The tone base pointer offset: found with the "signature" from the settings file, else BASE_POINTER_OFFSET."""
+    try:
+        signature = read_settings().get("signature")
+        if signature is None:
+            return BASE_POINTER_OFFSET
+        scan_start = time.perf_counter()
+        offset, source = resolve_base_pointer_offset(reader, module, signature)
+    except Exception as e:
+        q.put(f"Error scanning for the tone pointer signature: {e}. Using {BASE_POINTER_OFFSET:#x}.")
+        return BASE_POINTER_OFFSET
+    if offset is None:
+        q.put(f"Tone pointer signature not found in {module.name}. Using {BASE_POINTER_OFFSET:#x}.")
+        return BASE_POINTER_OFFSET
+    q.put(f"Tone base pointer at {module.name}+{offset:#x} (from {source}, {(time.perf_counter() - scan_start) * 1000:.0f} ms).")
+    return offset
+
+def report_mapping_reload(mapping, q):
+    """Hot-reloads the tone mapping and says so in the GUI."""
+    if mapping.maybe_reload():
+        if mapping.error:
+            q.put(mapping.error)
+        else:
+            q.put(f"Tone mapping reloaded from {mapping.path}.")
+
+def open_midi_outputs(q, selected_ports=None, selected_message_type=None):
+    """Opens the MIDI ports (from the config file unless given). Returns (midi_out, message type), or (None, None)."""
+    if selected_ports is None or selected_message_type is None:
+        import rtmidi
+        available_ports = rtmidi.MidiOut().get_ports()
+        selected_ports, selected_message_type = read_config()
+
+        if selected_ports is None or selected_message_type is None:
+            q.put("Missing port or message type selection. Please configure in the GUI.")
+            return None, None
+
+        for selected_port in selected_ports:
+            if selected_port not in range(len(available_ports)):
+                q.put(f"Port {selected_port} from the config file is not available. Please choose a valid port in the GUI.")
+                return None, None
+
+    midi_out = MidiOutputEngine()
+    try:  # Try to open the MIDI ports
+        for selected_port in selected_ports:
+            port = midi_out.open_port(selected_port)
+            q.put(f"Opened MIDI port {port.name}")
+        for url in read_settings().get("network", []):
+            port = midi_out.add_network_target(url)
+            q.put(f"Sending MIDI to {port.name}")
+        if not midi_out.ports:
+            q.put("No MIDI port or network target selected.")
+            midi_out.close()
+            return None, None
+    except Exception as e:
+        midi_out.close()
+        q.put(f"Error with MIDI: {e}")
+        return None, None
+    return midi_out, selected_message_type
+
+ATTACH_RETRY_MIN = 0.5  # Seconds before the first new attach attempt after a failure
+ATTACH_RETRY_MAX = 10.0  # The backoff doubles up to this
+
+class AttachSession:
+    """The game's process handle, module and watch list, opened once per game process and reused until it exits.
+
+    A failed attach or a read error drops the handle and the next attach is retried with an exponential backoff.
+    """
+
+    def __init__(self, module_name, q, retry_min=ATTACH_RETRY_MIN, retry_max=ATTACH_RETRY_MAX, watch_loader=None, label=None):
+        self.module_name = module_name
+        self.q = q
+        self.watch_loader = watch_loader  # base pointer offset -> [Watch]; the settings file's watches by default
+        self.prefix = f"[{label}] " if label else ""  # Tells the sources apart in the log
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.pid = None
+        self.process_handle = None
+        self.module = None
+        self.watches = None
+        self.attaches = 0
+        self.failures = 0
+        self.attach_time = None  # Seconds the last successful attach took
+        self._backoff = retry_min
+        self._retry_at = 0.0
+
+    def open(self, pid):
+        """The watch list for pid, attaching first if needed. None while attaching fails or the backoff runs."""
+        if pid != self.pid:
+            self.close()
+            self.pid = pid
+        if self.watches is not None:
+            return self.watches
+        if time.monotonic() < self._retry_at:
+            return None
+
+        attach_start = time.perf_counter()
+        try:
+            import pymem  # Only needed once the game is there
+            self.process_handle = pymem.Pymem(pid)
+            self.module = get_module(self.process_handle, self.module_name)
+            if self.module is None:
+                raise LookupError(f"Module '{self.module_name}' not found in process {pid}")
+            reader = PymemReader(self.process_handle)
+            base_address = self.module.lpBaseOfDll
+            base_pointer_offset = find_tone_base_pointer(reader, self.module, self.q)
+            try:
+                if self.watch_loader is not None:
+                    watches = WatchList(reader, base_address, self.watch_loader(base_pointer_offset))
+                else:
+                    watches = WatchList(reader, base_address, load_watches(base_pointer_offset=base_pointer_offset))
+            except Exception as e:
+                self.q.put(f"{self.prefix}Error loading watches from {SETTINGS_FILE}: {e}. Watching the tone only.")
+                watches = WatchList(reader, base_address, default_watches(base_pointer_offset))
+        except Exception as e:
+            self.fail(f"Could not attach to process {pid}: {e}")
+            return None
+
+        self.watches = watches
+        self.attach_time = time.perf_counter() - attach_start
+        self.attaches += 1
+        self._backoff = self.retry_min
+        self.q.put(f"{self.prefix}Attached to {self.module.name} at {self.module.lpBaseOfDll:#x} in {self.attach_time * 1000:.1f} ms.")
+        return watches
+
+    def fail(self, message):
+        """Drops the handle after an error and schedules the next attach attempt."""
+        self.failures += 1
+        self._release()
+        self.q.put(f"{self.prefix}{message}. Retrying in {self._backoff:.1f} s...")
+        self._retry_at = time.monotonic() + self._backoff
+        self._backoff = min(self._backoff * 2, self.retry_max)
+
+    def _release(self):
+        self.watches = None
+        self.module = None
+        if self.process_handle is not None:
+            try:
+                self.process_handle.close_process()
+            except Exception:
+                pass
+            self.process_handle = None
+
+    def close(self):
+        """Releases the process handle once the game has exited."""
+        self._release()
+        self.pid = None
+        self._backoff = self.retry_min
+        self._retry_at = 0.0
+
+def open_tone_filter(q):
+    """The settings file's tone filter, or the default one if the settings can't be read."""
+    try:
+        return load_tone_filter()
+    except Exception as e:
+        q.put(f"Error loading the tone filter from {SETTINGS_FILE}: {e}. Using the defaults.")
+        return ToneFilter()
+
+def report_session(q, midi_out, watches, scheduler, tone_filter=None):
+    """Logs the MIDI and memory counters of a game session that just ended."""
+    latency_stats.dump()  # Keep a machine-readable record of the session
+    for name, port_stats in midi_out.summary().items():
+        q.put(f"MIDI port {name}: {port_stats['sent']} sent, p99 send {port_stats['send']['p99_ms']} ms, {port_stats['errors']} error(s), {port_stats['dropped']} dropped.")
+    if watches is not None:
+        q.put(f"Memory reads: {watches.syscalls_per_tick:.2f} per tick for {len(watches.watches)} watch(es), {watches.resolves} chain walk(s) in {watches.ticks} ticks, {scheduler.overruns} overrun(s).")
+    for hook in hooks.hooks:
+        q.put(f"Hook {hook.name}: {hook.calls} call(s), p99 {hook.times.summary()['p99_ms']} ms, {hook.errors} error(s), {hook.timeouts} timeout(s), {hook.dropped} dropped.")
+    if tone_filter is not None:
+        q.put(f"Tone filter: {tone_filter.commits} change(s), {tone_filter.glitches} glitch(es) filtered, {tone_filter.suppressed} redundant send(s) suppressed.")
+
+def main_loop(q, window_title, module_name, frontend=None, selected_ports=None, selected_message_type=None, scheduler=None):
+    """The main game processing loop, running in a separate thread.
+
+    frontend is the optional GUI (test slider and game state); ports and message type default to the config file.
+    """
     
     last_slider_value = 0  # Initialize slider value
 
-    available_ports = rtmidi.MidiOut().get_ports()
-    selected_port, selected_message_type = read_config()
-
-    if selected_port is None or selected_message_type is None:
-        q.put("Missing port or message type selection. Please configure in the GUI.")
+    midi_out, selected_message_type = open_midi_outputs(q, selected_ports, selected_message_type)
+    if midi_out is None:
         return  # Exit the thread
 
-    if selected_port not in range(len(available_ports)):
-        q.put(f"Port {selected_port} from the config file is not available. Please choose a valid port in the GUI.")
-        return
-
-    try:  # Try to open the MIDI port
-        midi_out = rtmidi.MidiOut()
-        midi_out.open_port(selected_port)
-        
+    try:
         waiting_for_window_message_printed = False  # Flag for "Waiting for song..." message
+        if scheduler is None:
+            scheduler = PollScheduler()
+        try:
+            sources = load_sources(q, midi_out, selected_message_type, module_name)
+        except Exception as e:
+            q.put(f"Error loading sources from {SETTINGS_FILE}: {e}")
+            midi_out.close()
+            return
+        if sources:  # Several players or game instances, all polled from this thread
+            multi_source_loop(q, window_title, sources, midi_out, scheduler, frontend)
+            return
+        watcher = ProcessWatcher(module_name)
+        mapping = ToneMapping(selected_message_type)
+        if mapping.error:
+            q.put(mapping.error)
+        lookahead = load_lookahead(q)
+        load_hooks(q)
+        session = AttachSession(module_name, q)
+        for name, source in (("watcher", watcher), ("scheduler", scheduler), ("session", session), ("midi_out", midi_out), ("gui_queue", q)):
+            metrics.set_source(name, source)
 
         while True:
-        
-            if not is_game_running(window_title):
-                slider_value = midi_slider.get()
-                if slider_value != last_slider_value:  # Check if slider value changed
-                    midi_value = slider_value
-                    if selected_message_type == "control change":
-                        send_midi_control_change(1, 1, midi_value, midi_out)
-                        q.put(f"Sent MIDI Control Change: Channel 1, Control 1, Value {midi_value}")
-                    elif selected_message_type == "program change":
-                        send_midi_program_change(1, midi_value, midi_out)
-                        q.put(f"Sent MIDI Program Change: Channel 1, Program {midi_value}")
-                    last_slider_value = slider_value
+
+            event = watcher.poll()
+            report_mapping_reload(mapping, q)
+
+            if not watcher.attached:
+                if session.pid is not None:  # The game exited while we were reconnecting
+                    session.close()
+                    if frontend is not None:
+                        frontend.set_game_running(False)
+                if frontend is not None:
+                    slider_value = frontend.test_value()
+                    if slider_value != last_slider_value:  # Check if slider value changed
+                        description = send_tone_untracked(slider_value, mapping, midi_out)
+                        if description is not None:
+                            q.put(description)
+                        last_slider_value = slider_value
                     
                 if not waiting_for_window_message_printed:
-                    q.put(f"Before you launch the game you can test your MIDI connectivity / map your controls with the help of the slider below.\n{window_title} is not running. Waiting...")
+                    if frontend is not None:
+                        q.put(f"Before you launch the game you can test your MIDI connectivity / map your controls with the help of the slider below.\n{window_title} is not running. Waiting...")
+                    else:
+                        q.put(f"{window_title} is not running. Waiting...")
                     waiting_for_window_message_printed = True
-                time.sleep(1)
+                scheduler.set_state(POLL_STATE_ABSENT)
+                scheduler.wait()
                 continue
                 
             waiting_for_window_message_printed = False # Reset the flag when a valid tone_id is read
-            
-            # Check Game State
-            game_running = is_game_running(window_title)
-
-            # Visual Feedback for Slider State
-            if game_running:
-                midi_slider.config(troughcolor="indian red")  # Change trough color to gray
-                midi_slider.config(state=tk.DISABLED)
-            else:
-                midi_slider.config(troughcolor="gray50")  # Reset trough color (or set to your default)
-                midi_slider.config(state=tk.NORMAL)
-
-            pid = get_process_id_by_window_title(window_title)
 
-            try:
-                pm = pymem.Pymem(pid)
-
-                base_address = get_module_base_address(pm, module_name)
+            if event == PROCESS_ATTACHED:
+                if frontend is not None:
+                    frontend.set_game_running(True)
+                q.put(f"{window_title} found (PID {watcher.pid}) after {watcher.full_scans} process scan(s).")
 
-                if base_address is None:
-                    q.put(f"Module '{module_name}' not found in process {pid}.")
-                    continue
-
-                # ***REPLACE THESE WITH YOUR ACTUAL VALUES***
-                base_pointer_offset = 0xF5F54C  # Replace with your actual base pointer offset
-                offsets = [
-                    0x10,
-                    0x28,
-                    0x38,
-                    0x18,
-                    0x04,
-                    0xBC,
-                    0x10
-                ]
+            watches = session.open(watcher.pid)  # The same handle and module for the whole life of the process
+            if watches is None:
+                scheduler.set_state(POLL_STATE_IDLE)  # Waiting for the module to load or for the retry backoff
+                scheduler.wait()
+                continue
 
-                last_tone_id = None
-                waiting_for_song_message_printed = False
+            last_tone_id = None
+            waiting_for_song_message_printed = False
+            tone_filter = open_tone_filter(q)  # Per attach, so the first tone after a restart is always sent
+            metrics.set_source("watches", watches)
+            metrics.set_source("tone_filter", tone_filter)
+            hooks.emit(EVENT_ATTACHED, pid=session.pid, module=session.module.name, attach_time=session.attach_time)
 
-                while is_game_running(window_title):
-                    tone_id = read_memory_with_offsets(pm, base_address, base_pointer_offset, offsets)
+            try:
+                while watcher.poll() != PROCESS_DETACHED:
+                    report_mapping_reload(mapping, q)
+                    tone_id = poll_tone(watches, last_tone_id, mapping, midi_out, q, tone_filter)
+                    if tone_filter.confirming:
+                        scheduler.confirm_soon()
+                    if lookahead is not None:
+                        send_lookahead(lookahead, watches, mapping, midi_out, q, tone_filter)
 
                     if tone_id is None:
                         if not waiting_for_song_message_printed:
                             q.put("Waiting for song...")
                             waiting_for_song_message_printed = True
-                        time.sleep(1)
+                        scheduler.set_state(POLL_STATE_IDLE)
+                        scheduler.wait()
                         continue
 
                     waiting_for_song_message_printed = False
-                    
-                    if tone_id != last_tone_id:
-                        if tone_id == 5:
-                            cc_value = 0
-                        else:
-                            cc_value = tone_id
-
-                        if selected_message_type == "control change":
-                            send_midi_control_change(1, 1, cc_value, midi_out)
-                            q.put(f"Sent MIDI Control Change: Channel 1, Control 1, Value {cc_value}")
-                        elif selected_message_type == "program change":
-                            send_midi_program_change(1, cc_value, midi_out)
-                            q.put(f"Sent MIDI Program Change: Channel 1, Program {cc_value}")
-                        last_tone_id = tone_id
-
-                    time.sleep(0.1)
-
-                del pm
-                q.put(f"{window_title} closed. Waiting for it to restart...")
-
-            except pymem.exception.ProcessNotFound:
-                q.put(f"{window_title} is not running. Waiting...")
-                time.sleep(1)
-                continue
+                    scheduler.set_state(POLL_STATE_ACTIVE)
+                    last_tone_id = tone_id
+                    scheduler.wait()
 
             except Exception as e:
-                q.put(f"An error occurred: {e}")
-                break
+                metrics.set_source("watches", None)
+                session.fail(f"An error occurred: {e}")  # Reattach after a backoff instead of stopping the engine
+                continue
 
-        del midi_out  # Close the MIDI port when the game closes
+            if frontend is not None:
+                frontend.set_game_running(False)
+            report_session(q, midi_out, watches, scheduler, tone_filter)
+            metrics.set_source("watches", None)
+            hooks.emit(EVENT_DETACHED, pid=session.pid)
+            del watches
+            session.close()  # Releases the process handle
+            q.put(f"{window_title} closed. Waiting for it to restart... ({watcher.full_scans} process scans so far)")
 
-    except Exception as e:  # Catch any exceptions during MIDI port opening or usage
+        midi_out.close()  # Close the MIDI ports when the loop ends
+
+    except Exception as e:  # Catch any exceptions during MIDI port usage
         q.put(f"Error with MIDI: {e}")
         return  # Exit the thread if there's an error with MIDI
-          
+
+class Source:
+    """One monitored tone slot: its pointer chain, mapping, output route, tone filter and latency stats."""
+
+    def __init__(self, name, index, game, base, offsets, mapping, route, q, arrangement=None):
+        self.name = name
+        self.index = index  # Position in the "sources" list, kept in session recordings
+        self.game = game  # The GameInstance it is read from, shared with the other sources on it
+        self.base = base  # Base pointer offset, None for the one found by find_tone_base_pointer
+        self.offsets = offsets
+        self.watch_name = f"{name} tone"  # Its watch in the game's WatchList
+        self.mapping = mapping
+        self.route = route
+        self.q = q
+        self.stats = LatencyStats(parent=latency_stats)
+        self.tone_filter = None
+        self.last_tone_id = None
+        self.waiting_for_song = False
+        self.arrangement = arrangement  # Timeline arrangement this player follows, the "timeline" one by default
+        self.lookahead = None  # Its ToneLookahead, set by multi_source_loop when there is a timeline
+
+    def tone_watch(self, base_pointer_offset):
+        return Watch(self.watch_name, self.base if self.base is not None else base_pointer_offset, self.offsets, valid_range=TONE_VALID_RANGE)
+
+    def attach(self, session):
+        self.tone_filter = open_tone_filter(self.q)  # Per attach, so the first tone after a restart is always sent
+        self.last_tone_id = None
+        self.waiting_for_song = False
+        hooks.emit(EVENT_ATTACHED, source=self.name, pid=session.pid, module=session.module.name, attach_time=session.attach_time)
+
+    def tick(self, watches, poll_start, read_time):
+        """Handles this source's tone after the game's watches were read. Returns its poll state."""
+        self.stats.record(STAGE_READ, read_time)
+        tone_id = update_tone(watches.values[self.watch_name], poll_start, self.last_tone_id, self.mapping, self.route, self.q,
+                              self.tone_filter, self.stats, self)
+        if self.lookahead is not None:
+            send_lookahead(self.lookahead, watches, self.mapping, self.route, self.q, self.tone_filter, self)
+        if tone_id is None:
+            if not self.waiting_for_song:
+                self.q.put(f"[{self.name}] Waiting for song...")
+                self.waiting_for_song = True
+            return POLL_STATE_IDLE
+        self.waiting_for_song = False
+        self.last_tone_id = tone_id
+        return POLL_STATE_ACTIVE
+
+    def detach(self, pid):
+        sent = self.stats.summary()[STAGE_SEND]
+        self.q.put(f"[{self.name}] Game closed. {sent['count']} tone change(s) sent, p50 {sent['p50_ms']} ms, p99 {sent['p99_ms']} ms.")
+        if self.tone_filter is not None:
+            self.q.put(f"[{self.name}] Tone filter: {self.tone_filter.commits} change(s), {self.tone_filter.glitches} glitch(es) filtered, "
+                       f"{self.tone_filter.suppressed} redundant send(s) suppressed.")
+        hooks.emit(EVENT_DETACHED, source=self.name, pid=pid)
+
+class GameInstance:
+    """One running copy of the game and the sources read from it, which share its process watcher,
+    attach session and WatchList: one handle and one pointer walk for all of them. The "watches" of the
+    settings file are read from every instance, and their CCs sent to all of midi_out's ports."""
+
+    def __init__(self, process_name, instance, q, midi_out):
+        self.process_name = process_name
+        self.instance = instance
+        self.q = q
+        self.midi_out = midi_out
+        self.watcher = ProcessWatcher(process_name, instance=instance)
+        self.session = AttachSession(process_name, q, watch_loader=self.load_watches, label=f"{process_name} #{instance + 1}")
+        self.sources = []
+        self.watches = None
+
+    def load_watches(self, base_pointer_offset):
+        watches = [source.tone_watch(base_pointer_offset) for source in self.sources]
+        try:
+            watches += [watch for watch in load_watches(base_pointer_offset=base_pointer_offset) if watch.name != "tone"]
+        except Exception as e:
+            self.q.put(f"{self.session.prefix}Error loading watches from {SETTINGS_FILE}: {e}. Watching the tones only.")
+        return watches
+
+    def tick(self):
+        """Reads the tone of every source once. Returns the most urgent poll state among them."""
+        if not self.watcher.attached:
+            if self.session.pid is not None:
+                self.detach()
+            return POLL_STATE_ABSENT
+
+        watches = self.session.open(self.watcher.pid)
+        if watches is None:
+            self.watches = None
+            return POLL_STATE_IDLE  # Waiting for the module to load or for the retry backoff
+        if watches is not self.watches:
+            self.watches = watches
+            for source in self.sources:
+                source.attach(self.session)
+
+        try:
+            poll_start = time.perf_counter()
+            changes = watches.poll()
+            read_time = time.perf_counter() - poll_start
+            if changes:
+                send_watch_changes(changes, watches, self.midi_out)
+            states = [source.tick(watches, poll_start, read_time) for source in self.sources]
+        except Exception as e:
+            self.watches = None
+            self.session.fail(f"An error occurred: {e}")
+            return POLL_STATE_IDLE
+        return POLL_STATE_ACTIVE if POLL_STATE_ACTIVE in states else POLL_STATE_IDLE
+
+    def detach(self):
+        for source in self.sources:
+            source.detach(self.session.pid)
+        self.watches = None
+        self.session.close()
+
+def load_sources(q, midi_out, message_type, module_name, path=SETTINGS_FILE):
+    """Builds the sources listed in the "sources" section of the settings file, e.g.
+
+    "sources": [
+        {"name": "player 1", "channel": 1, "ports": [0]},
+        {"name": "player 2", "offsets": ["0x10", "0x28", "0x38", "0x18", "0x08", "0xBC", "0x10"], "channel": 2, "ports": [0]},
+        {"name": "lab 2", "instance": 1, "network": ["osc://10.0.0.5:9000/midi"]}
+    ]
+    "process" and "instance" (0 is the oldest copy running) pick the game, "base" and "offsets" the tone
+    pointer chain, "channel" or "tones" the mapping, "ports" and "network" the outputs (default: the ones
+    opened from the config, command line and top-level "network", never another source's) and "arrangement"
+    the part of the "timeline" it follows. Sources on the same game instance share one GameInstance.
+    """
+    def number(value):
+        return int(value, 0) if isinstance(value, str) else value
+
+    games = {}
+    sources = []
+    default_ports = list(midi_out.ports)  # Before the sources open their own
+    for entry in read_settings(path).get("sources", []):
+        name = entry["name"]
+        if any(source.name == name for source in sources):
+            raise ValueError(f"Duplicate source name '{name}'")
+        process_name = entry.get("process", module_name)
+        instance = int(entry.get("instance", 0))
+        if (process_name, instance) not in games:
+            games[process_name, instance] = GameInstance(process_name, instance, q, midi_out)
+        game = games[process_name, instance]
+
+        base = number(entry["base"]) if "base" in entry else None
+        offsets = [number(offset) for offset in entry.get("offsets", TONE_OFFSETS)]
+
+        ports = [midi_out.open_port(int(index)) for index in entry.get("ports", [])]
+        ports += [midi_out.add_network_target(url) for url in entry.get("network", [])]
+        route = MidiRoute(ports if ports else default_ports)
+
+        mapping = ToneMapping(message_type, path, source=name, channel=int(entry.get("channel", 1)))
+        if mapping.error:
+            q.put(f"[{name}] {mapping.error}")
+        source = Source(name, len(sources), game, base, offsets, mapping, route, q, entry.get("arrangement"))
+        game.sources.append(source)
+        sources.append(source)
+        q.put(f"Source {name}: {process_name} #{instance + 1}, sending to {', '.join(port.name for port in route.ports)}")
+    return sources
+
+def multi_source_loop(q, window_title, sources, midi_out, scheduler, frontend=None):
+    """Polls every source from one thread: each tick reads every game instance once, then sleeps for the most urgent state."""
+    games = []
+    for source in sources:
+        if source.game not in games:
+            games.append(source.game)
+    for name, source in (("scheduler", scheduler), ("midi_out", midi_out), ("gui_queue", q), ("sources", sources)):
+        metrics.set_source(name, source)
+    lookahead = load_lookahead(q)
+    if lookahead is not None:  # One per source, as players may follow different arrangements of the song
+        for source in sources:
+            source.lookahead = ToneLookahead(lookahead.library, lookahead.lead, (source.arrangement or lookahead.arrangement).lower())
+    load_hooks(q)
+
+    last_slider_value = 0
+    game_running = False
+    waiting_for_window_message_printed = False
+    while True:
+        for game in games:
+            event = game.watcher.poll()
+            if event == PROCESS_ATTACHED:
+                q.put(f"{window_title} #{game.instance + 1} found (PID {game.watcher.pid}) after {game.watcher.full_scans} process scan(s).")
+            elif event == PROCESS_DETACHED:
+                report_session(q, midi_out, game.watches, scheduler)
+                q.put(f"{window_title} #{game.instance + 1} closed. Waiting for it to restart...")
+
+        for source in sources:
+            report_mapping_reload(source.mapping, q)
+        states = [game.tick() for game in games]
+
+        if POLL_STATE_ACTIVE in states:
+            scheduler.set_state(POLL_STATE_ACTIVE)
+        elif POLL_STATE_IDLE in states:
+            scheduler.set_state(POLL_STATE_IDLE)
+        else:
+            scheduler.set_state(POLL_STATE_ABSENT)
+        if any(source.tone_filter is not None and source.tone_filter.confirming for source in sources):
+            scheduler.confirm_soon()
+
+        running = any(game.watcher.attached for game in games)
+        if running != game_running:
+            game_running = running
+            waiting_for_window_message_printed = False
+            if frontend is not None:
+                frontend.set_game_running(running)
+        if not running:
+            if frontend is not None:
+                slider_value = frontend.test_value()
+                if slider_value != last_slider_value:
+                    description = send_tone_untracked(slider_value, sources[0].mapping, midi_out)
+                    if description is not None:
+                        q.put(description)
+                    last_slider_value = slider_value
+            if not waiting_for_window_message_printed:
+                q.put(f"{window_title} is not running. Waiting...")
+                waiting_for_window_message_printed = True
+
+        scheduler.wait()
+
+CONTROL_ADDRESS = "127.0.0.1:47800"  # Or "unix:/path/to/socket"
+CONTROL_MAX_BACKLOG = 100  # Events queued for a slow subscriber before it starts missing them
+
+def positive_milliseconds(key, value):
+    """A control socket setting in ms, as seconds. Rejects zero, negative and non-finite values."""
+    milliseconds = float(value)
+    if not 0 < milliseconds < float("inf"):
+        raise ValueError(f"{key} must be a positive number of milliseconds")
+    return milliseconds / 1000
+
+class AsyncEngine:
+    """The engine as cooperating asyncio tasks (process watching, memory polling, MIDI dispatch) with a control socket.
+
+    The control socket speaks JSON lines: {"cmd": "status"}, {"cmd": "set", "key": "poll_ms", "value": 2},
+    {"cmd": "resend"} and {"cmd": "subscribe"}, which streams tone change and attach/detach events.
+    Polling sleeps with asyncio.sleep(), so its resolution is that of the event loop's timer
+    (about 15 ms on Windows); main_loop remains the choice for the fastest poll rates.
+    """
+
+    def __init__(self, q, window_title, module_name, midi_out, mapping, scheduler=None, frontend=None):
+        self.q = q
+        self.window_title = window_title
+        self.module_name = module_name
+        self.midi_out = midi_out
+        self.mapping = mapping
+        self.scheduler = scheduler if scheduler is not None else PollScheduler()
+        self.frontend = frontend
+        self.watcher = ProcessWatcher(module_name)
+        self.watches = None
+        self.tone_filter = ToneFilter()
+        self.lookahead = None
+        self.last_tone_id = None
+        self.last_slider_value = 0
+        self.subscribers = set()
+        self.dispatch_queue = None  # Created in run(), it has to belong to the running loop
+        self.session = AttachSession(module_name, q)
+
+    def broadcast(self, event):
+        """Sends an event to every subscriber; a subscriber that falls behind misses events instead of growing a backlog."""
+        for subscriber in self.subscribers:
+            if subscriber.qsize() < CONTROL_MAX_BACKLOG:
+                subscriber.put_nowait(event)
+
+    async def _attach(self):
+        pid = self.watcher.pid
+        loop = asyncio.get_running_loop()
+        # Opening the process and a signature scan can take a while, keep them off the event loop
+        self.watches = await loop.run_in_executor(None, self.session.open, pid)
+        if self.watches is None:
+            return
+        self.last_tone_id = None
+        self.tone_filter = open_tone_filter(self.q)
+        metrics.set_source("watches", self.watches)
+        metrics.set_source("tone_filter", self.tone_filter)
+        hooks.emit(EVENT_ATTACHED, pid=pid, module=self.session.module.name, attach_time=self.session.attach_time)
+        self.broadcast({"event": "attached", "pid": pid})
+
+    async def watch_process(self):
+        waiting_for_window_message_printed = False
+        while True:
+            event = self.watcher.poll()
+            report_mapping_reload(self.mapping, self.q)
+
+            if event == PROCESS_ATTACHED:
+                waiting_for_window_message_printed = False
+                if self.frontend is not None:
+                    self.frontend.set_game_running(True)
+                self.q.put(f"{self.window_title} found (PID {self.watcher.pid}) after {self.watcher.full_scans} process scan(s).")
+                await self._attach()
+            elif event == PROCESS_DETACHED:
+                if self.frontend is not None:
+                    self.frontend.set_game_running(False)
+                report_session(self.q, self.midi_out, self.watches, self.scheduler, self.tone_filter)
+                metrics.set_source("watches", None)
+                self.watches = None
+                hooks.emit(EVENT_DETACHED, pid=self.session.pid)
+                self.session.close()
+                self.broadcast({"event": "detached"})
+                self.q.put(f"{self.window_title} closed. Waiting for it to restart... ({self.watcher.full_scans} process scans so far)")
+            elif self.watcher.attached and self.watches is None:
+                await self._attach()  # The session keeps to its retry backoff
+            elif not self.watcher.attached:
+                if self.frontend is not None:
+                    slider_value = self.frontend.test_value()
+                    if slider_value != self.last_slider_value:
+                        description = send_tone_untracked(slider_value, self.mapping, self.midi_out)
+                        if description is not None:
+                            self.q.put(description)
+                        self.last_slider_value = slider_value
+                if not waiting_for_window_message_printed:
+                    self.q.put(f"{self.window_title} is not running. Waiting...")
+                    waiting_for_window_message_printed = True
+
+            await asyncio.sleep(POLL_INTERVAL_ABSENT)
+
+    async def poll_memory(self):
+        waiting_for_song_message_printed = False
+        while True:
+            watches = self.watches
+            if watches is None:
+                self.scheduler.set_state(POLL_STATE_ABSENT)
+            else:
+                try:
+                    poll_start = time.perf_counter()
+                    changes = watches.poll()
+                    latency_stats.record(STAGE_READ, time.perf_counter() - poll_start)
+                    if changes:
+                        send_watch_changes(changes, watches, self.midi_out)
+                        self.broadcast({"event": "values", "values": changes})
+
+                    tone_id = update_tone(watches.values["tone"], poll_start, self.last_tone_id, self.mapping, self.midi_out, self.q,
+                                          self.tone_filter, send=self.queue_tone)
+                    if self.tone_filter.confirming:
+                        self.scheduler.confirm_soon()
+                    if tone_id is None:
+                        if not waiting_for_song_message_printed:
+                            self.q.put("Waiting for song...")
+                            waiting_for_song_message_printed = True
+                        self.scheduler.set_state(POLL_STATE_IDLE)
+                    else:
+                        waiting_for_song_message_printed = False
+                        self.scheduler.set_state(POLL_STATE_ACTIVE)
+                        self.last_tone_id = tone_id
+                    if self.lookahead is not None:
+                        send_lookahead(self.lookahead, watches, self.mapping, self.midi_out, self.q, self.tone_filter)
+                except Exception as e:
+                    metrics.set_source("watches", None)
+                    self.watches = None
+                    self.session.fail(f"An error occurred: {e}")  # watch_process reattaches after the backoff
+
+            await asyncio.sleep(self.scheduler.next_delay())
+            self.scheduler.woke()
+
+    def queue_tone(self, tone_id, poll_start):
+        """update_tone's send: the dispatch task sends it, so a slow port never holds up the polling."""
+        self.dispatch_queue.put_nowait((tone_id, poll_start, False))
+
+    async def dispatch(self):
+        while True:
+            tone_id, poll_start, resend = await self.dispatch_queue.get()
+            if resend:
+                description = send_tone_untracked(tone_id, self.mapping, self.midi_out)
+            else:
+                description = send_tone(tone_id, self.mapping, self.midi_out, latency_stats, poll_start)
+            if description is not None:
+                self.q.put((description, poll_start))
+            self.broadcast({"event": "tone", "tone_id": tone_id, "messages": [message.hex() for message in self.mapping.messages[tone_id]]})
+
+    def status(self):
+        return {
+            "attached": self.watcher.attached,
+            "pid": self.watcher.pid,
+            "tone_id": self.last_tone_id,
+            "values": dict(self.watches.values) if self.watches is not None else {},
+            "poll_state": self.scheduler.state,
+            "poll_ms": self.scheduler.active_interval * 1000,
+            "target_latency_ms": None if self.scheduler.target_latency is None else self.scheduler.target_latency * 1000,
+            "message_type": self.mapping.message_type,
+            "process_scans": self.watcher.full_scans,
+            "syscalls_per_tick": self.watches.syscalls_per_tick if self.watches is not None else None,
+            "tone_filter": {"glitches": self.tone_filter.glitches, "suppressed": self.tone_filter.suppressed},
+            "latency": latency_stats.summary(),
+            "midi_ports": self.midi_out.summary(),
+            "subscribers": len(self.subscribers),
+        }
+
+    def apply_setting(self, key, value):
+        """Live config changes from the control socket."""
+        if key == "poll_ms":
+            self.scheduler.active_interval = positive_milliseconds(key, value)
+        elif key == "target_latency_ms":
+            self.scheduler.target_latency = None if value is None else positive_milliseconds(key, value)
+        elif key == "message_type":
+            if value not in ("program change", "control change"):
+                raise ValueError("message_type must be 'program change' or 'control change'")
+            self.mapping.set_message_type(value)
+        else:
+            raise ValueError(f"Unknown setting '{key}'")
+        self.q.put(f"Control: {key} set to {value}")
+
+    def handle_command(self, request):
+        if not isinstance(request, dict):
+            return {"ok": False, "error": 'Expected a JSON object like {"cmd": "status"}'}
+        command = request.get("cmd")
+        try:
+            if command == "status":
+                return {"ok": True, "status": self.status()}
+            if command == "set":
+                self.apply_setting(request.get("key"), request.get("value"))
+                return {"ok": True}
+            if command == "resend":
+                if self.last_tone_id is None:
+                    return {"ok": False, "error": "No tone to resend"}
+                self.dispatch_queue.put_nowait((self.last_tone_id, time.perf_counter(), True))
+                return {"ok": True, "tone_id": self.last_tone_id}
+        except (TypeError, ValueError) as e:
+            return {"ok": False, "error": str(e)}
+        return {"ok": False, "error": f"Unknown command '{command}'"}
+
+    async def _stream_events(self, writer):
+        subscriber = asyncio.Queue()
+        self.subscribers.add(subscriber)
+        try:
+            while True:
+                event = await subscriber.get()
+                writer.write(json.dumps(event).encode() + b"\n")
+                await writer.drain()
+        finally:
+            self.subscribers.discard(subscriber)
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    request = None
+                if isinstance(request, dict) and request.get("cmd") == "subscribe":
+                    await self._stream_events(writer)
+                    break
+                writer.write(json.dumps(self.handle_command(request)).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # The client went away
+        finally:
+            writer.close()
+
+    async def start_control_server(self, address=CONTROL_ADDRESS):
+        if address.startswith("unix:"):
+            server = await asyncio.start_unix_server(self.handle_client, path=address[len("unix:"):])
+        else:
+            host, port = address.rsplit(":", 1)
+            server = await asyncio.start_server(self.handle_client, host, int(port))
+        self.q.put(f"Control socket listening on {address}")
+        return server
+
+    async def run(self, control_address=None):
+        self.dispatch_queue = asyncio.Queue()
+        self.lookahead = load_lookahead(self.q)
+        load_hooks(self.q)
+        for name, source in (("watcher", self.watcher), ("scheduler", self.scheduler), ("session", self.session), ("midi_out", self.midi_out), ("gui_queue", self.q)):
+            metrics.set_source(name, source)
+        tasks = [self.watch_process(), self.poll_memory(), self.dispatch()]
+        if control_address is not None:
+            server = await self.start_control_server(control_address)
+            tasks.append(server.serve_forever())
+        await asyncio.gather(*tasks)
+
+def async_main_loop(q, window_title, module_name, frontend=None, selected_ports=None, selected_message_type=None, scheduler=None,
+                    control_address=CONTROL_ADDRESS):
+    """Runs the AsyncEngine (and its control socket) on the calling thread."""
+    midi_out, selected_message_type = open_midi_outputs(q, selected_ports, selected_message_type)
+    if midi_out is None:
+        return
+    mapping = ToneMapping(selected_message_type)
+    if mapping.error:
+        q.put(mapping.error)
+    try:
+        has_sources = bool(read_settings().get("sources"))
+    except ValueError:
+        has_sources = False  # The mapping already reported the broken file
+    if has_sources:
+        q.put(f"The control socket engine watches a single source, \"sources\" in {SETTINGS_FILE} is ignored.")
+    engine = AsyncEngine(q, window_title, module_name, midi_out, mapping, scheduler, frontend)
+    try:
+        asyncio.run(engine.run(control_address))
+    except Exception as e:
+        q.put(f"An error occurred: {e}")
+    finally:
+        midi_out.close()
+
+def replay_main_loop(q, path, speed=1.0, selected_ports=None, selected_message_type=None, module_name=None):
+    """Replays a session recording through the normal mapping and MIDI outputs (each source's own, when the
+    settings file lists several), then reports how it compared."""
+    midi_out, selected_message_type = open_midi_outputs(q, selected_ports, selected_message_type)
+    if midi_out is None:
+        return
+    try:
+        mapping = ToneMapping(selected_message_type)
+        if mapping.error:
+            q.put(mapping.error)
+        sources = load_sources(q, midi_out, selected_message_type, module_name)
+        routes = {source.index: (source.mapping, source.route) for source in sources}
+        stats = replay_recording(path, mapping, midi_out, q, speed, routes=routes)
+        q.put(f"Replay finished: {stats['sessions']} session(s), {stats['tone_changes']} tone changes, {stats['sent']} messages sent, "
+              f"{stats['mismatches']} differ from the {stats['recorded']} recorded.")
+    except Exception as e:
+        q.put(f"An error occurred: {e}")
+    finally:
+        midi_out.close()
+
+def query_control(address, command):
+    """Sends one command to a running engine's control socket and prints the reply (or the event stream)."""
+    async def query():
+        if address.startswith("unix:"):
+            reader, writer = await asyncio.open_unix_connection(address[len("unix:"):])
+        else:
+            host, port = address.rsplit(":", 1)
+            reader, writer = await asyncio.open_connection(host, int(port))
+        writer.write(command.encode() + b"\n")
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            print(line.decode().rstrip(), flush=True)
+            if '"subscribe"' not in command:
+                break
+        writer.close()
+
+    if not command.lstrip().startswith("{"):
+        command = json.dumps({"cmd": command})
+    try:
+        asyncio.run(query())
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"Could not reach the engine at {address}: {e}")
+        return 1
+    return 0
+
+def load_tkinter():
+    """Imports Tk for the GUI; the headless mode never calls this."""
+    global tk, ttk, scrolledtext, Toplevel, Label, Menu, Scale, webbrowser
+    import tkinter as tk
+    from tkinter import ttk, scrolledtext, Toplevel, Label, Menu, Scale
+    import webbrowser
+
+class GuiFrontend:
+    """Connects the engine thread to the Tk window: the test slider and its colours."""
+
+    def __init__(self, slider):
+        self.slider = slider
+
+    def test_value(self):
+        return self.slider.get()
+
+    def set_game_running(self, running):
+        # Visual Feedback for Slider State
+        if running:
+            self.slider.config(troughcolor="indian red")  # Change trough color to gray
+            self.slider.config(state=tk.DISABLED)
+        else:
+            self.slider.config(troughcolor="gray50")  # Reset trough color (or set to your default)
+            self.slider.config(state=tk.NORMAL)
+
 def open_config_window():
     """Opens the MIDI configuration window."""
     config_window = Toplevel(root)  # Create a new top-level window
@@ -274,6 +3144,7 @@ def open_config_window():
     port_label.pack(pady=(0, 5))
 
     port_var = tk.StringVar(config_window)
+    import rtmidi
     available_ports = rtmidi.MidiOut().get_ports() # Get ports inside the function
     port_options = [f"{i}: {port_name}" for i, port_name in enumerate(available_ports)]
 
@@ -362,18 +3233,128 @@ def open_about_window():
     about_window.transient(root)
     about_window.grab_set()
     
+def open_stats_window():
+    """Opens a window with live latency percentiles per pipeline stage."""
+    stats_window = Toplevel(root)
+    stats_window.title("Latency Stats")
+
+    stats_label = Label(stats_window, font=("Courier", 10), justify=tk.LEFT)
+    stats_label.pack(padx=10, pady=10)
+
+    def refresh():
+        if stats_window.winfo_exists():
+            stats_label.config(text=latency_stats.format())
+            stats_window.after(500, refresh)
+
+    def save_stats():
+        latency_stats.dump()
+        q.put(f"Latency stats saved to {os.path.abspath(STATS_FILE)}")
+
+    save_button = ttk.Button(stats_window, text="Save as JSON", command=save_stats)
+    save_button.pack(pady=(0, 10))
+
+    refresh()
+    stats_window.transient(root)
+
 def open_help_link():
     help_link = "https://github.com/bboylalu/RSTone2MIDI"  # Replace with your actual help link
     webbrowser.open_new(help_link)
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Sends MIDI messages based on the current tone in Rocksmith 2014.")
+    parser.add_argument("--headless", action="store_true", help="Run the engine without the GUI (Tk is never loaded)")
+    parser.add_argument("--list-ports", action="store_true", help="List the MIDI output ports and exit")
+    parser.add_argument("--ports", help="MIDI port number(s) to use, e.g. 0 or 0,2 (default: the config file)")
+    parser.add_argument("--message-type", choices=["program change", "control change"], help="Default mapping message type (default: the config file)")
+    parser.add_argument("--poll-ms", type=float, default=POLL_INTERVAL_ACTIVE * 1000, help="Poll interval while a song is playing")
+    parser.add_argument("--target-latency-ms", type=float, default=TARGET_LATENCY * 1000, help="Worst-case tone change detection time to aim for")
+    parser.add_argument("--control", nargs="?", const=CONTROL_ADDRESS, metavar="ADDRESS",
+                        help=f"Run the asyncio engine with a control socket on host:port or unix:/path (default: {CONTROL_ADDRESS})")
+    parser.add_argument("--metrics", nargs="?", const=METRICS_ADDRESS, metavar="ADDRESS",
+                        help=f"Serve Prometheus metrics on host:port/metrics (default: {METRICS_ADDRESS}) and dump them to {METRICS_FILE}")
+    parser.add_argument("--record", metavar="FILE", help="Append every tone read and MIDI message sent to a binary recording")
+    parser.add_argument("--replay", metavar="FILE", help="Send the tone changes of a recording instead of reading the game (headless)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed, 2 replays twice as fast (default: real time)")
+    parser.add_argument("--query", metavar="CMD", help="Send a command (status, resend, subscribe or a JSON line) to a running engine's control socket and exit")
+    return parser.parse_args(argv)
+
+def run_headless(args, window_title, module_name):
+    """Runs the engine on its own thread and prints its messages. Returns the exit code."""
+    import rtmidi
+    available_ports = rtmidi.MidiOut().get_ports()
+
+    if args.list_ports:
+        for i, port_name in enumerate(available_ports):
+            print(f"{i}: {port_name}")
+        return 0
+
+    selected_ports, selected_message_type = read_config()
+    if args.ports is not None:
+        selected_ports = [int(port) for port in args.ports.split(",") if port.strip()]  # "" sends to the network targets only
+    if args.message_type is not None:
+        selected_message_type = args.message_type
+    if selected_ports is None or selected_message_type is None:
+        print(f"Missing port or message type. Use --ports and --message-type, or run the GUI once to write {CONFIG_FILE}.")
+        return 1
+    for selected_port in selected_ports:
+        if selected_port not in range(len(available_ports)):
+            print(f"Port {selected_port} is not available. Use --list-ports to see the valid ones.")
+            return 1
+
+    scheduler = PollScheduler(active_interval=args.poll_ms / 1000, target_latency=args.target_latency_ms / 1000)
+    q = queue.Queue()
+    engine_kwargs = {"selected_ports": selected_ports, "selected_message_type": selected_message_type, "scheduler": scheduler}
+    if args.replay is not None:
+        engine_thread = threading.Thread(target=replay_main_loop, args=(q, args.replay, args.speed),
+                                         kwargs={"selected_ports": selected_ports, "selected_message_type": selected_message_type,
+                                                 "module_name": module_name})
+    else:
+        if args.control is not None:
+            engine_kwargs["control_address"] = args.control
+        engine_thread = threading.Thread(target=async_main_loop if args.control is not None else main_loop, args=(q, window_title, module_name),
+                                         kwargs=engine_kwargs)
+    engine_thread.daemon = True
+    engine_thread.start()
+
+    try:
+        while engine_thread.is_alive() or not q.empty():
+            try:
+                message = q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if isinstance(message, tuple):  # (text, start of the poll that produced it)
+                message = message[0]
+            print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+    except KeyboardInterrupt:
+        print("Stopped.")
+    stop_recording()
+    latency_stats.dump()
+    return 0
+
 if __name__ == "__main__":
     window_title = "Rocksmith 2014"
     module_name = "Rocksmith2014.exe"
 
+    args = parse_args()
+    if args.query is not None:
+        sys.exit(query_control(args.control or CONTROL_ADDRESS, args.query))
+    if args.record is not None and args.replay is None:
+        start_recording(args.record)
+    if args.metrics is not None:
+        try:
+            metrics.start(args.metrics)
+            print(f"Metrics on http://{args.metrics}/metrics")
+        except OSError as e:
+            print(f"Could not serve metrics on {args.metrics}: {e}")
+    if args.headless or args.list_ports or args.replay is not None:
+        sys.exit(run_headless(args, window_title, module_name))
+
+    load_tkinter()
+    import rtmidi
     available_ports = rtmidi.MidiOut().get_ports()
-    selected_port, selected_message_type = read_config()
+    selected_ports, selected_message_type = read_config()
 
-    if selected_port is None or selected_message_type is None:
+    if selected_ports is None or selected_message_type is None:
         if available_ports:
             root = tk.Tk()
             root.title("MIDI Configuration")
@@ -429,9 +3410,9 @@ if __name__ == "__main__":
         else:
             print("No MIDI ports found.")
             exit()
-    elif selected_port not in range(len(available_ports)):
-        print(f"Port {selected_port} from the config file is not available. Please choose a valid port.")
-        selected_port = None
+    elif any(selected_port not in range(len(available_ports)) for selected_port in selected_ports):
+        print(f"Port(s) {selected_ports} from the config file are not all available. Please choose a valid port.")
+        selected_ports = None
         if available_ports:
             root = tk.Tk()
             root.title("MIDI Configuration")
@@ -481,6 +3462,7 @@ if __name__ == "__main__":
 
     # Add Config and Exit to File Menu
     filemenu.add_command(label="Settings", command=open_config_window)
+    filemenu.add_command(label="Latency Stats", command=open_stats_window)
     filemenu.add_separator() # Separator line
     filemenu.add_command(label="Exit", command=root.destroy)
     
@@ -496,18 +3478,25 @@ if __name__ == "__main__":
 
     message_display = scrolledtext.ScrolledText(root, wrap=tk.WORD)
     message_display.pack(expand=True, fill=tk.BOTH)
+    gui_log = GuiLog()
 
     q = queue.Queue()
 
-    main_thread = threading.Thread(target=main_loop, args=(q, window_title, module_name))
-    main_thread.daemon = True
-    main_thread.start()
-
-    root.after(100, update_gui_messages, q)
-        
     # MIDI Value Slider
     midi_slider = Scale(root, from_=0, to=3, orient=tk.HORIZONTAL, label="Test MIDI (0-3)")
     midi_slider.pack(pady=(10, 0))
     midi_slider.set(0)
+
+    scheduler = PollScheduler(active_interval=args.poll_ms / 1000, target_latency=args.target_latency_ms / 1000)
+    engine_kwargs = {"scheduler": scheduler}
+    if args.control is not None:
+        engine_kwargs["control_address"] = args.control
+    main_thread = threading.Thread(target=async_main_loop if args.control is not None else main_loop, args=(q, window_title, module_name, GuiFrontend(midi_slider)),
+                                   kwargs=engine_kwargs)
+    main_thread.daemon = True
+    main_thread.start()
+
+    root.after(100, update_gui_messages, q)
     
     root.mainloop()
+    stop_recording()
@@ -0,0 +1,541 @@
+import argparse
+import ctypes
+import json
+import os
+import queue
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import RSTone2MIDI as engine
+
+"""
+RSTone2MIDI benchmarks
+Runs the polling and MIDI pipeline against a simulated game and a loopback MIDI sink,
+so latency and throughput can be measured headless (e.g. on Linux in CI).
+
+Usage: python RSTone2MIDI_bench.py [--duration 5] [--poll-ms 4] [--json bench.json]
+Exits with 1 when a correctness check (signature scan, /proc reads, replay, glitch filter) fails.
+"""
+
+MODULE_BASE = 0x400000
+HEAP_BASE = 0x10000000
+
+class FakeGame:
+    """A simulated Rocksmith process: the tone pointer chain from main_loop laid out in fake memory."""
+
+    def __init__(self):
+        self.reader = engine.FakeMemoryReader()
+        self.base_pointer_address = MODULE_BASE + engine.BASE_POINTER_OFFSET
+        self.reader.map(self.base_pointer_address, 4)
+        self.reader.map(HEAP_BASE, 0x1000)
+
+        # One heap object per pointer in the chain, the last one holds the tone slot
+        self.first_node = HEAP_BASE
+        current = self.first_node
+        for i, offset in enumerate(engine.TONE_OFFSETS[:-1]):
+            next_node = HEAP_BASE + 0x100 * (i + 1)
+            self.reader.write_int(current + offset, next_node)
+            current = next_node
+        self.tone_address = current + engine.TONE_OFFSETS[-1]
+        self.flips = []  # (perf_counter, tone_id) for every scripted tone change
+
+    def new_watches(self, extra_fields=0, null_fields=0):
+        """The tone watch plus extra_fields more int32 fields next to it in the same game object.
+
+        null_fields adds watches behind a null pointer, like song-only values while in the menus.
+        """
+        watches = engine.default_watches()
+        for i in range(extra_fields):
+            offsets = engine.TONE_OFFSETS[:-1] + [engine.TONE_OFFSETS[-1] + 4 * (i + 1)]
+            watches.append(engine.Watch(f"field {i + 1}", engine.BASE_POINTER_OFFSET, offsets))
+        for i in range(null_fields):
+            offsets = [engine.TONE_OFFSETS[0], 0x80 + 4 * i, 0x10]  # Zero filled heap, so the walk stops there
+            watches.append(engine.Watch(f"null field {i + 1}", engine.BASE_POINTER_OFFSET, offsets))
+        return engine.WatchList(self.reader, MODULE_BASE, watches)
+
+    def load_song(self, tone_id=0):
+        self.set_tone(tone_id)
+        self.reader.write_int(self.base_pointer_address, self.first_node)
+
+    def unload_song(self):
+        self.reader.write_int(self.base_pointer_address, 0)
+
+    def set_tone(self, tone_id):
+        self.reader.write_int(self.tone_address, tone_id)
+
+    def play(self, timeline, stop_event):
+        """Flips tone ids at the scripted (seconds, tone_id) times, on the caller's thread."""
+        start = time.perf_counter()
+        for at, tone_id in timeline:
+            delay = start + at - time.perf_counter()
+            if stop_event.wait(max(delay, 0)):
+                return
+            self.set_tone(tone_id)
+            self.flips.append((time.perf_counter(), tone_id))
+
+class LoopbackMidiOut:
+    """Stands in for rtmidi.MidiOut and timestamps every message sent to it."""
+
+    def __init__(self):
+        self.received = []  # (perf_counter, bytes)
+
+    def get_ports(self):
+        return ["Loopback"]
+
+    def open_port(self, port=0):
+        pass
+
+    def send_message(self, message):
+        self.received.append((time.perf_counter(), bytes(message)))
+
+class WedgedMidiOut(LoopbackMidiOut):
+    """A port whose driver takes far too long on every send."""
+
+    def __init__(self, delay=0.05):
+        super().__init__()
+        self.delay = delay
+
+    def send_message(self, message):
+        time.sleep(self.delay)
+        super().send_message(message)
+
+GLITCH_TONE = 99  # The garbage value a glitching pointer chain reads during a transition
+
+def make_timeline(duration, switch_interval, seed=1, glitch=0.0):
+    """Tone changes every switch_interval seconds (+/- 30% jitter), never repeating the current tone.
+
+    With glitch, every change is preceded by GLITCH_TONE for that many seconds.
+    """
+    rng = random.Random(seed)
+    timeline = []
+    at = switch_interval
+    tone_id = 0
+    while at < duration:
+        tone_id = rng.choice([t for t in (0, 1, 2, 3) if t != tone_id])
+        if glitch:
+            timeline.append((at - glitch, GLITCH_TONE))
+        timeline.append((at, tone_id))
+        at += switch_interval * rng.uniform(0.7, 1.3)
+    return timeline
+
+def percentiles(samples):
+    histogram = engine.RollingHistogram(size=max(len(samples), 1))
+    for sample in samples:
+        histogram.add(sample)
+    return histogram.summary()
+
+def bench_detection(duration, switch_interval, poll_interval, glitch=0.0, tone_filter=None):
+    """Runs the real poll loop against scripted tone flips and measures flip -> MIDI send latency."""
+    game = FakeGame()
+    game.load_song(0)
+    watches = game.new_watches()
+    midi_out = LoopbackMidiOut()
+    mapping = engine.ToneMapping("program change", path=None)
+    q = queue.Queue()
+    scheduler = engine.PollScheduler(active_interval=poll_interval)
+
+    stop_event = threading.Event()
+    player = threading.Thread(target=game.play, args=(make_timeline(duration, switch_interval, glitch=glitch), stop_event))
+    player.daemon = True
+
+    last_tone_id = None
+    end = time.perf_counter() + duration
+    cpu_start = time.thread_time()
+    player.start()
+    while time.perf_counter() < end:
+        tone_id = engine.poll_tone(watches, last_tone_id, mapping, midi_out, q, tone_filter)
+        if tone_filter is not None and tone_filter.confirming:
+            scheduler.confirm_soon()
+        scheduler.set_state(engine.POLL_STATE_ACTIVE if tone_id is not None else engine.POLL_STATE_IDLE)
+        if tone_id is not None:
+            last_tone_id = tone_id
+        scheduler.wait()
+    cpu_used = time.thread_time() - cpu_start
+    stop_event.set()
+    player.join()
+
+    # Match every flip with the first message sent after it
+    latencies = []
+    received = iter(midi_out.received)
+    for flipped_at, tone_id in game.flips:
+        if tone_id == GLITCH_TONE:
+            continue
+        for sent_at, message in received:
+            if sent_at >= flipped_at and message[1] == tone_id:
+                latencies.append(sent_at - flipped_at)
+                break
+
+    return {
+        "tone_changes": sum(1 for _, tone_id in game.flips if tone_id != GLITCH_TONE),
+        "detected": len(latencies),
+        "spurious_sends": sum(1 for _, message in midi_out.received if message[1] == GLITCH_TONE),
+        "detection_latency": percentiles(latencies),
+        "polls": watches.ticks,
+        "cpu_per_poll_us": round(cpu_used / max(watches.ticks, 1) * 1e6, 2),
+        "syscalls_per_tick": round(watches.syscalls_per_tick, 3),
+        "overruns": scheduler.overruns,
+    }
+
+def bench_glitch_filter(duration, switch_interval, poll_interval, glitch=0.0005):
+    """Tone changes preceded by a short garbage read, without and with the ToneFilter."""
+    return {
+        "unfiltered": bench_detection(duration, switch_interval, poll_interval, glitch),
+        "filtered": bench_detection(duration, switch_interval, poll_interval, glitch, engine.ToneFilter()),
+    }
+
+def bench_throughput(count):
+    """Changes the tone on every poll without sleeping, to measure how many messages/sec the pipeline can push."""
+    game = FakeGame()
+    game.load_song(0)
+    watches = game.new_watches()
+    midi_out = LoopbackMidiOut()
+    mapping = engine.ToneMapping("program change", path=None)
+    q = queue.Queue()
+
+    last_tone_id = None
+    start = time.perf_counter()
+    for i in range(count):
+        game.set_tone(1 + i % 2)
+        last_tone_id = engine.poll_tone(watches, last_tone_id, mapping, midi_out, q)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "messages": len(midi_out.received),
+        "messages_per_sec": round(len(midi_out.received) / elapsed),
+        "syscalls_per_tick": round(watches.syscalls_per_tick, 3),
+    }
+
+def bench_fanout(tone_changes, burst=4):
+    """Sends bursts of messages (one burst per tone change) to two healthy ports and one wedged port."""
+    midi_out = engine.MidiOutputEngine()
+    healthy = [LoopbackMidiOut(), LoopbackMidiOut()]
+    midi_out.add_port("loopback 1", healthy[0])
+    midi_out.add_port("loopback 2", healthy[1])
+    midi_out.add_port("wedged", WedgedMidiOut())
+
+    count = tone_changes * burst
+    enqueue_time = 0.0
+    start = time.perf_counter()
+    for i in range(tone_changes):
+        burst_start = time.perf_counter()
+        for j in range(burst):
+            engine.send_midi_control_change(1, j, i % 128, midi_out)
+        enqueue_time += time.perf_counter() - burst_start
+        time.sleep(0.001)
+
+    # Wait for the healthy ports to drain; the wedged one is not waited for
+    deadline = time.perf_counter() + 5
+    while any(len(sink.received) < count for sink in healthy) and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    ports = midi_out.summary()
+    midi_out.close()
+    return {
+        "enqueue_us": round(enqueue_time / count * 1e6, 3),
+        "delivered_per_sec": round(min(len(sink.received) for sink in healthy) / elapsed),
+        "ports": {name: {key: ports[name][key] for key in ("sent", "dropped", "send")} for name in ports},
+    }
+
+def bench_network(tone_changes, messages_per_change=2):
+    """Sends tone changes to UDP and OSC targets on a local listener and measures send -> receive latency."""
+    results = {}
+    for protocol in ("udp", "osc"):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.settimeout(1.0)
+        received = []  # (perf_counter, datagram)
+
+        def receive():
+            while len(received) < tone_changes:
+                try:
+                    data = listener.recv(65536)
+                except socket.timeout:
+                    return
+                received.append((time.perf_counter(), data))
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        midi_out = engine.MidiOutputEngine()
+        port = midi_out.add_network_target(f"{protocol}://127.0.0.1:{listener.getsockname()[1]}/midi")
+        messages = [bytes((0xC0, 1)), bytes((0xB0, 7, 100)), bytes((0xB0, 11, 64))][:messages_per_change]
+
+        sent_at = []
+        for _ in range(tone_changes):
+            sent_at.append(time.perf_counter())
+            midi_out.send_messages(messages)
+            time.sleep(0.001)
+        receiver.join()
+        summary = port.summary()
+        midi_out.close()
+        listener.close()
+
+        results[protocol] = {
+            "tone_changes": tone_changes,
+            "datagrams": len(received),
+            "bytes_per_datagram": len(received[0][1]) if received else None,
+            "latency": percentiles([at - start for (at, _), start in zip(received, sent_at)]),
+            "send": summary["send"],
+        }
+    return results
+
+def bench_uncached_reads(count):
+    """Syscalls and time per read for the full pointer walk versus the cached chain of a one-watch WatchList."""
+    game = FakeGame()
+    game.load_song(2)
+    chain = game.new_watches()
+
+    reads_before = game.reader.reads
+    start = time.perf_counter()
+    for _ in range(count):
+        engine.read_memory_with_offsets(game.reader, MODULE_BASE, engine.BASE_POINTER_OFFSET, engine.TONE_OFFSETS)
+    walk_time = time.perf_counter() - start
+    walk_reads = game.reader.reads - reads_before
+
+    start = time.perf_counter()
+    for _ in range(count):
+        chain.poll()
+    chain_time = time.perf_counter() - start
+
+    return {
+        "full_walk_syscalls": round(walk_reads / count, 3),
+        "full_walk_us": round(walk_time / count * 1e6, 3),
+        "cached_chain_syscalls": round(chain.syscalls_per_tick, 3),
+        "cached_chain_us": round(chain_time / count * 1e6, 3),
+    }
+
+def bench_watch_scaling(count, sizes=(1, 2, 4, 8, 16)):
+    """Syscalls and time per tick as more fields of the same game object are watched."""
+    game = FakeGame()
+    game.load_song(1)
+    results = {}
+    for size in sizes:
+        watches = game.new_watches(extra_fields=size - 1)
+        start = time.perf_counter()
+        for _ in range(count):
+            watches.poll()
+        elapsed = time.perf_counter() - start
+        results[f"{size} watches"] = {
+            "syscalls_per_tick": round(watches.syscalls_per_tick, 3),
+            "us_per_tick": round(elapsed / count * 1e6, 3),
+        }
+
+    # A watch behind a null pointer must not make every other chain walk again on each tick
+    watches = game.new_watches(null_fields=1)
+    for _ in range(count):
+        watches.poll()
+    results["tone + 1 null watch"] = {
+        "syscalls_per_tick": round(watches.syscalls_per_tick, 3),
+        "resolves": watches.resolves,
+    }
+    return results
+
+def bench_proc_mem(count):
+    """Reads a known buffer of this process through /proc/self/mem, the Linux test path of the memory readers."""
+    if not os.path.exists("/proc/self/mem"):
+        return {"skipped": "no /proc/self/mem"}
+    values = (ctypes.c_int32 * 16)(*range(-8, 8))
+    address = ctypes.addressof(values)
+    reader = engine.ProcMemReader(os.getpid())
+    try:
+        matches = all(reader.read_int(address + 4 * i) == values[i] for i in range(len(values)))
+        matches = matches and reader.read_bytes(address, ctypes.sizeof(values)) == bytes(values)
+        start = time.perf_counter()
+        for _ in range(count):
+            reader.read_int(address)
+        elapsed = time.perf_counter() - start
+    finally:
+        reader.close()
+    return {
+        "values_match": matches,
+        "read_int_us": round(elapsed / count * 1e6, 3),
+    }
+
+def bench_sources(count, sizes=(1, 2, 4)):
+    """Time per tick when one thread polls several sources of one game: a shared WatchList read once per tick,
+    then each source's own filter, mapping, route and stats."""
+    game = FakeGame()
+    game.load_song(1)
+    q = queue.Queue()
+    results = {}
+    for size in sizes:
+        sources = []
+        for i in range(size):
+            source = types.SimpleNamespace(name=f"source {i + 1}", index=i, last_tone_id=None, tone_filter=engine.ToneFilter(),
+                                           mapping=engine.ToneMapping("program change", path=None, channel=i + 1),
+                                           route=LoopbackMidiOut(), stats=engine.LatencyStats(parent=engine.latency_stats))
+            sources.append(source)
+        watches = engine.WatchList(game.reader, MODULE_BASE, [engine.Watch(f"{source.name} tone", engine.BASE_POINTER_OFFSET, engine.TONE_OFFSETS,
+                                                                           valid_range=engine.TONE_VALID_RANGE) for source in sources])
+        start = time.perf_counter()
+        for tick in range(count):
+            game.set_tone(1 + tick // 4 % 2)
+            poll_start = time.perf_counter()
+            watches.poll()
+            for source in sources:
+                source.last_tone_id = engine.update_tone(watches.values[f"{source.name} tone"], poll_start, source.last_tone_id, source.mapping,
+                                                         source.route, q, source.tone_filter, source.stats, source)
+        elapsed = time.perf_counter() - start
+        results[f"{size} sources"] = {
+            "us_per_tick": round(elapsed / count * 1e6, 3),
+            "syscalls_per_tick": round(watches.syscalls_per_tick, 3),
+            "send_p99_ms": max(source.stats.summary()[engine.STAGE_SEND]["p99_ms"] for source in sources),
+        }
+    return results
+
+BENCH_SIGNATURE = {"pattern": "A1 ?? ?? ?? ?? 8B 48 10 85 C9 74 ?? 8B 41 28", "offset": 1}
+
+def bench_signature_scan(module_size=24 * 1024 * 1024):
+    """Scans a module image of random bytes for a signature planted near its end, then repeats it from the cache."""
+    reader = engine.FakeMemoryReader()
+    reader.map(MODULE_BASE, module_size)
+    reader.write_bytes(MODULE_BASE, os.urandom(module_size))
+    code = bytes.fromhex("A1") + (MODULE_BASE + engine.BASE_POINTER_OFFSET).to_bytes(4, "little") + bytes.fromhex("8B 48 10 85 C9 74 05 8B 41 28")
+    reader.write_bytes(MODULE_BASE + module_size - 4096, code)
+
+    # The benchmark's own interpreter stands in for the game executable in the cache key
+    module = types.SimpleNamespace(name="fake.exe", lpBaseOfDll=MODULE_BASE, SizeOfImage=module_size, filename=sys.executable)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_file = os.path.join(cache_dir, "scan_cache.json")
+        reads_before = reader.reads
+        start = time.perf_counter()
+        offset, source = engine.resolve_base_pointer_offset(reader, module, BENCH_SIGNATURE, cache_file)
+        scan_time = time.perf_counter() - start
+        scan_reads = reader.reads - reads_before
+
+        start = time.perf_counter()
+        cached_offset, cached_source = engine.resolve_base_pointer_offset(reader, module, BENCH_SIGNATURE, cache_file)
+        cache_time = time.perf_counter() - start
+
+    return {
+        "module_mb": module_size // (1024 * 1024),
+        "found": offset == engine.BASE_POINTER_OFFSET and cached_offset == offset,
+        "scan_ms": round(scan_time * 1000, 3),
+        "scan_reads": scan_reads,
+        "scan_mb_per_sec": round(module_size / (1024 * 1024) / scan_time),
+        "cached_ms": round(cache_time * 1000, 3),
+        "sources": [source, cached_source],
+    }
+
+def bench_process_watch(count):
+    """Cost of a full process scan versus the cached PID check, using this benchmark's own process."""
+    import psutil
+    own_name = psutil.Process().name()
+    watcher = engine.ProcessWatcher(own_name, alive_interval=0)
+
+    start = time.perf_counter()
+    watcher.poll()  # Attaches with one full scan
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(count):
+        watcher.poll()
+    check_time = time.perf_counter() - start
+
+    return {
+        "attached": watcher.attached,
+        "full_scan_ms": round(scan_time * 1000, 3),
+        "cached_check_us": round(check_time / count * 1e6, 3),
+        "full_scans": watcher.full_scans,
+    }
+
+def bench_recording(count):
+    """Per-tick cost of recording every tone change, then replays the file as fast as possible and checks it matches.
+
+    Like a live session the reads go through a ToneFilter: tones are held for a few ticks and every 50th tick is a glitch.
+    """
+    game = FakeGame()
+    game.load_song(0)
+    watches = game.new_watches()
+    mapping = engine.ToneMapping("program change", path=None)
+    q = queue.Queue()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.rec")
+
+        def run(record):
+            midi_out = engine.MidiOutputEngine()
+            midi_out.add_port("loopback", LoopbackMidiOut())
+            if record:
+                engine.start_recording(path)
+            tone_filter = engine.ToneFilter()
+            last_tone_id = None
+            start = time.perf_counter()
+            for i in range(count):
+                game.set_tone(GLITCH_TONE if i % 50 == 49 else 1 + i // 4 % 2)
+                last_tone_id = engine.poll_tone(watches, last_tone_id, mapping, midi_out, q, tone_filter)
+            elapsed = time.perf_counter() - start
+            engine.stop_recording()
+            midi_out.close()
+            return elapsed
+
+        plain_time = run(False)
+        record_time = run(True)
+
+        midi_out = engine.MidiOutputEngine()
+        midi_out.add_port("loopback", LoopbackMidiOut())
+        start = time.perf_counter()
+        replay = engine.replay_recording(path, mapping, midi_out, q, speed=1e9, new_filter=engine.ToneFilter)
+        replay_time = time.perf_counter() - start
+        midi_out.close()
+
+        return {
+            "tick_us": round(plain_time / count * 1e6, 3),
+            "recording_tick_us": round(record_time / count * 1e6, 3),
+            "bytes_per_tone_change": round(os.path.getsize(path) / replay["tone_changes"], 1),
+            "replay_changes_per_sec": round(replay["tone_changes"] / replay_time),
+            "replay_mismatches": replay["mismatches"],
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the RSTone2MIDI polling and MIDI pipeline against a simulated game.")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds of simulated play for the latency benchmark")
+    parser.add_argument("--switch-interval", type=float, default=0.25, help="Average seconds between scripted tone changes")
+    parser.add_argument("--poll-ms", type=float, default=engine.POLL_INTERVAL_ACTIVE * 1000, help="Active poll interval in ms")
+    parser.add_argument("--count", type=int, default=100000, help="Iterations for the throughput benchmarks")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = {
+        "detection": bench_detection(args.duration, args.switch_interval, args.poll_ms / 1000),
+        "glitch_filter": bench_glitch_filter(args.duration, args.switch_interval, args.poll_ms / 1000),
+        "throughput": bench_throughput(args.count),
+        "fanout": bench_fanout(min(args.count, 1000)),
+        "network": bench_network(min(args.count, 1000)),
+        "pointer_chain": bench_uncached_reads(args.count),
+        "watch_scaling": bench_watch_scaling(min(args.count, 20000)),
+        "sources": bench_sources(min(args.count, 20000)),
+        "signature_scan": bench_signature_scan(),
+        "proc_mem": bench_proc_mem(min(args.count, 10000)),
+        "process_watch": bench_process_watch(min(args.count, 10000)),
+        "recording": bench_recording(min(args.count, 20000)),
+        "stages": engine.latency_stats.summary(),
+    }
+
+    for name, values in results.items():
+        print(f"[{name}]")
+        for key, value in values.items():
+            print(f"  {key}: {value}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    # Correctness checks, so a CI run fails instead of only printing a wrong result
+    checks = {
+        "signature_scan.found": results["signature_scan"]["found"],
+        "proc_mem.values_match": results["proc_mem"].get("values_match", True),  # Skipped without /proc/self/mem
+        "recording.replay_mismatches == 0": results["recording"]["replay_mismatches"] == 0,
+        "glitch_filter.filtered.spurious_sends == 0": results["glitch_filter"]["filtered"]["spurious_sends"] == 0,
+    }
+    failed = [name for name, passed in checks.items() if not passed]
+    for name in failed:
+        print(f"FAILED: {name}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())